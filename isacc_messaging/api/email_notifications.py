@@ -1,12 +1,20 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
+from types import SimpleNamespace
 
 import click
 
 from flask import current_app
+from jinja2 import Environment
+from markupsafe import Markup
 
-from isacc_messaging.models.email import send_email
+from isacc_messaging.audit import audit_entry
+from isacc_messaging.models.email import send_email, send_emails_batch
 from isacc_messaging.models.fhir import next_in_bundle
+from isacc_messaging.models.isacc_fhirdate import local_now
 from isacc_messaging.models.isacc_patient import (
     IsaccPatient as Patient,
     LAST_UNFOLLOWEDUP_URL,
@@ -14,123 +22,335 @@ from isacc_messaging.models.isacc_patient import (
 )
 from isacc_messaging.models.isacc_practitioner import IsaccPractitioner as Practitioner
 
+logger = logging.getLogger(__name__)
+
+ISACC_USER_ID_SYSTEM = "http://isacc.app/user-id"
+# limit on recipients of a single email, to stay within provider limits
+MAX_RECIPIENTS_PER_EMAIL = 50
+
+# background senders for notifications, see `send_message_received_notification()`;
+# drained at exit, so queued notifications are sent rather than dropped
+_mail_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="isacc-mail")
+atexit.register(_mail_executor.shutdown, wait=True)
+
 html_template = """
     <html>
       <head></head>
       <body>
-        <p>{pre_link_msg}
+        <p>{{ pre_link_msg }}
         <br><br>
-           Go to <a href="{link_url}">ISACC</a> {link_suffix_text}.
+           Go to <a href="{{ link_url }}">ISACC</a> {{ link_suffix_text }}.
         </p>
-        <p>{post_link_msg}
+        <p>{{ post_link_msg }}
         </p>
-        <p><a href="{unsubscribe_link}">Click here to unsubscribe.</a></p>
+        <p><a href="{{ unsubscribe_link }}">Click here to unsubscribe.</a></p>
       </body>
     </html>
     """
 
+# html_template compiled once at import, see `_render()`.  Values are
+# escaped unless marked safe with `Markup`
+_HTML_TEMPLATE = Environment(autoescape=True).from_string(html_template)
+
+
+def _render(pre_link_msg, link_url, link_suffix_text, post_link_msg, unsubscribe_link):
+    """Render html_template with given values"""
+    return _HTML_TEMPLATE.render(
+        pre_link_msg=pre_link_msg,
+        link_url=link_url,
+        link_suffix_text=link_suffix_text,
+        post_link_msg=post_link_msg,
+        unsubscribe_link=unsubscribe_link)
+
+
+@lru_cache(maxsize=1)
+def _email_cfg(app):
+    """Config derived values used throughout email content, built once per app
+
+    :param app: Flask app, also serving as the cache key, so a new app (or
+      `_email_cfg.cache_clear()`) picks up config changes
+    """
+    app_url = app.config.get("ISACC_APP_URL")
+    support_email = app.config.get("ISACC_SUPPORT_EMAIL")
+    return SimpleNamespace(
+        app_url=app_url,
+        unsub_link=f"{app_url}/unsubscribe",
+        support_email=support_email,
+        site_lead_html=Markup(
+            "If you are not the person who should be getting these messages, contact "
+            '<a href="mailto:{}">your site lead</a>.').format(support_email),
+        subject_default=app.config.get("ISACC_NOTIFICATION_EMAIL_SUBJECT", "New message received"),
+        patient_list_outgoing=f"{app_url}/home?sort_by=next_message&sort_direction=desc&flags=following",
+        patient_list_unresponded=f"{app_url}/home?flags=following",
+        notification_async=app.config.get("ISACC_NOTIFICATION_ASYNC"),
+    )
+
+
+def email_config():
+    """Return config derived values for email content, see `_email_cfg()`"""
+    return _email_cfg(current_app._get_current_object())
+
+
+def _send_email_in_background(app, **kwargs):
+    """Call `send_email()` with kwargs, within app context of a worker thread"""
+    with app.app_context():
+        send_email(**kwargs)
+
+
+def _audit_background_failure(app, recipients, future):
+    """Done callback auditing a failed background send, as nothing awaits its result"""
+    error = future.exception()
+    if error is None:
+        return
+    with app.app_context():
+        audit_entry(
+            "Failed to send message received notification",
+            extra={"recipients": recipients, "exception": str(error)},
+            level='error'
+        )
+
 
 def send_message_received_notification(recipients: list, patient: Patient):
-    SUPPORT_EMAIL = current_app.config.get('ISACC_SUPPORT_EMAIL')
-    UNSUB_LINK = f'{current_app.config.get("ISACC_APP_URL")}/unsubscribe'
-    subject = current_app.config.get('ISACC_NOTIFICATION_EMAIL_SUBJECT', 'New message received')
+    """Notify recipients of message received from patient
+
+    Content is assembled in the calling thread.  Unless disabled by the
+    ``ISACC_NOTIFICATION_ASYNC`` config, the send itself is handed to a
+    background thread, keeping SMTP latency out of the request; failures
+    there are audited, see `_audit_background_failure()`.
+    """
+    if not recipients:
+        return
+    # one RCPT TO per address, preserving order
+    recipients = list(dict.fromkeys(recipients))
+
+    cfg = email_config()
+    subject = cfg.subject_default
     query = f"sof_client_id=MESSAGING&patient={patient.id}"
-    link_url = f'{current_app.config.get("ISACC_APP_URL")}/target?{query}'
-    user_ids = patient.identifier and [i for i in patient.identifier if i.system == "http://isacc.app/user-id"] or None
-    user_id = user_ids[0].value if user_ids else "no ID assigned"
+    link_url = f'{cfg.app_url}/target?{query}'
+    match = next((i for i in (patient.identifier or ()) if i.system == ISACC_USER_ID_SYSTEM), None)
+    user_id = match.value if match else "no ID assigned"
     msg = f"ISACC received a message from ISACC recipient ({user_id})."
     link = f"Go to {link_url} to view it."
     text = '\n'.join((msg, link))
-    html = html_template.format(
+    html = _render(
         pre_link_msg=msg,
         link_url=link_url,
         link_suffix_text="to view it",
-        post_link_msg=(
-            "If you are not the person who should be getting these messages, contact "
-            f'<a href="mailto:{SUPPORT_EMAIL}">your site lead</a>.'),
-        unsubscribe_link=UNSUB_LINK)
+        post_link_msg=cfg.site_lead_html,
+        unsubscribe_link=cfg.unsub_link)
 
-    send_email(
+    email = dict(
         recipient_emails=recipients,
         subject=subject,
         text=text,
         html=html,
     )
+    if not cfg.notification_async:
+        send_email(**email)
+        return
+    app = current_app._get_current_object()
+    future = _mail_executor.submit(_send_email_in_background, app, **email)
+    future.add_done_callback(partial(_audit_background_failure, app, recipients))
+
+
+def partition_by_primary(practitioner, patients):
+    """Split patients by whether practitioner is their primary (general) practitioner
+
+    :return: tuple of lists (primary, secondary), where secondary holds
+      patients the practitioner is only following
+    """
+    primary_ref = f"Practitioner/{practitioner.id}"
+    primary, secondary = [], []
+    primary_append, secondary_append = primary.append, secondary.append
+    for p in patients:
+        gp = p.generalPractitioner
+        if gp and gp[0].reference == primary_ref:
+            primary_append(p)
+        else:
+            secondary_append(p)
+    return primary, secondary
 
 
-def assemble_outgoing_counts_email(practitioner, patients):
+def assemble_outgoing_counts_email(practitioner, patients, cfg=None):
     """Pull together email content for given practitioner and their list of patients
 
     :param practitioner: Practitioner object, target of email
     :param patients: list of Patient objects for whom the practitioner is assigned,
       expected to only include those with an outgoing message in the next 24 hours
+    :param cfg: config derived values from `email_config()`, looked up if not given
     :return: email content
     """
-    SUPPORT_EMAIL = current_app.config.get('ISACC_SUPPORT_EMAIL')
-    UNSUB_LINK = f'{current_app.config.get("ISACC_APP_URL")}/unsubscribe'
-    patient_list_url = f'{current_app.config.get("ISACC_APP_URL")}/home?sort_by=next_message&sort_direction=desc&flags=following'
-    primary, secondary = [], []
-    for p in patients:
-        if p.generalPractitioner and p.generalPractitioner[0].reference == f"Practitioner/{practitioner.id}":
-            primary.append(p)
-            continue
-        secondary.append(p)
+    if cfg is None:
+        cfg = email_config()
+    patient_list_url = cfg.patient_list_outgoing
+    primary, secondary = partition_by_primary(practitioner, patients)
 
     subject = f"ISACC {len(patients)} Caring Contact sending today"
-    contents = []
-    contents.append(f"Today Caring Contact messages will be sent to {len(primary)} recipients for")
-    contents.append(f"whom you are the primary author, and {len(secondary)} for whom you are following.")
-    msg = " ".join(contents)
-    contents.append(f"Click here {patient_list_url} to view which of your recipients will be receiving a message.")
-    contents.append("If you are not the person who should be getting these messages, contact your site lead.")
-    html = html_template.format(
+    msg = " ".join((
+        f"Today Caring Contact messages will be sent to {len(primary)} recipients for",
+        f"whom you are the primary author, and {len(secondary)} for whom you are following."))
+    text = " ".join((
+        msg,
+        f"Click here {patient_list_url} to view which of your recipients will be receiving a message.",
+        "If you are not the person who should be getting these messages, contact your site lead."))
+    html = _render(
         pre_link_msg=msg,
         link_url=patient_list_url,
         link_suffix_text="to view which of your recipients will be receiving a message",
-        post_link_msg=(
-            "If you are not the person who should be getting these messages, contact "
-            f'<a href="mailto:{SUPPORT_EMAIL}">your site lead</a>.'),
-        unsubscribe_link=UNSUB_LINK)
+        post_link_msg=cfg.site_lead_html,
+        unsubscribe_link=cfg.unsub_link)
 
     return {
         "subject": subject,
-        "text": " ".join(contents),
+        "text": text,
         "html": html}
 
 
-def unique_by_id_add(container, item):
-    """only add item to container if the item.id is not already in container
-
-    NB: mutates container by adding item if not already present
-    """
-    already_present = [i for i in container if i.id == item.id]
-    if already_present:
-        return
-    container.add(item)
-
+def filter_patients(patients, filter_func, keeper_ids, skipper_ids):
+    """helper to return only sublist of patients using filter function
 
-known_keepers = set()  # set of unique patient ids
-known_skippers = set() # set of unique patient ids
+    :param patients: list of Patient objects to filter
+    :param filter_func: function returning true for patients to keep
+    :param keeper_ids: set of patient ids previously found to pass filter_func
+    :param skipper_ids: set of patient ids previously found to fail filter_func
 
-
-def filter_patients(patients, filter_func):
-    """helper to return only sublist of patients using filter function"""
-    keepers = set()
+    NB: mutates keeper_ids and skipper_ids, memoizing filter_func results for
+    the duration of a run, as patients are commonly shared by practitioners.
+    Called only from the assembling thread; worker threads just send the
+    assembled emails, see `_dispatch_practitioner_emails()`.
+    """
+    keepers: dict[str, Patient] = {}  # unique by patient id
     for p in patients:
         id = p.id
-        if id in known_keepers:
-            unique_by_id_add(container=keepers, item=p)
+        if id in keeper_ids:
+            keepers.setdefault(id, p)
             continue
-        if id in known_skippers:
+        if id in skipper_ids:
             continue
 
         if filter_func(p):
-            unique_by_id_add(container=keepers, item=p)
-            known_keepers.add(id)
+            keepers.setdefault(id, p)
+            keeper_ids.add(id)
         else:
-            known_skippers.add(id)
+            skipper_ids.add(id)
+
+    return list(keepers.values())
+
+
+def _assemble_practitioner_email(
+        cfg, practitioner, category, filter_func, keeper_ids, skipper_ids,
+        assemble_func, patients_by_practitioner):
+    """Assemble email for a single practitioner
 
-    return list(keepers)
+    :param cfg: config derived values from `email_config()`
+    :param practitioner: Practitioner object, target of email
+    :param category: name of email category, used in logging
+    :param filter_func: function to determine which patients qualify
+    :param keeper_ids: memo of qualifying patient ids, see `filter_patients()`
+    :param skipper_ids: memo of non-qualifying patient ids, see `filter_patients()`
+    :param assemble_func: function to assemble email content
+    :param patients_by_practitioner: patients keyed by practitioner id, see
+      `Practitioner.patients_by_practitioner()`
+    :return: email content, or None if no patients qualify
+    """
+    practitioners_patients = patients_by_practitioner.get(practitioner.id, [])
+    patients = filter_patients(
+        patients=practitioners_patients,
+        filter_func=filter_func,
+        keeper_ids=keeper_ids,
+        skipper_ids=skipper_ids)
+    if not patients:
+        logger.debug("no qualifying %s patients for %s", category, practitioner)
+        return
+
+    return assemble_func(practitioner, patients, cfg=cfg)
+
+
+def _send_practitioner_emails(app, messages, dry_run):
+    """Send (or echo on dry_run) a batch of practitioner emails
+
+    :param app: Flask app, as this runs in a worker thread without app context
+    :param messages: list of `send_email()` keyword argument dicts
+    :param dry_run: set true to echo rather than send email
+    """
+    with app.app_context():
+        if not dry_run:
+            send_emails_batch(messages)
+            return
+
+        for message in messages:
+            click.echo(
+                f"email to: {', '.join(message['recipient_emails'])}\n"
+                f"subject: {message['subject']}\n"
+                f"body: {message['text']}\n\n"
+                f"html: {message['html']}\n\n"
+            )
+
+
+def _dispatch_practitioner_emails(category, filter_func, assemble_func, dry_run, include_test_patients):
+    """Generate and send email to all active practitioners with qualifying patients
+
+    Patients for all practitioners are fetched up front in bulk, from which
+    each practitioner's email is assembled.  Practitioners receiving identical
+    content share a single email (up to ``MAX_RECIPIENTS_PER_EMAIL``), with
+    recipients undisclosed.  Sending is dominated by SMTP round trips, so
+    the emails are split into batches for a small pool of worker threads
+    (configured by ``ISACC_EMAIL_CONCURRENCY``), each sending its batch over
+    a single SMTP connection.
+    """
+    app = current_app._get_current_object()
+    cfg = email_config()
+    max_workers = int(current_app.config.get("ISACC_EMAIL_CONCURRENCY", 5))
+    # filter results memoized by patient id, for the duration of this run
+    keeper_ids: set[str] = set()
+    skipper_ids: set[str] = set()
+
+    patients_by_practitioner = Practitioner.patients_by_practitioner(
+        include_test_patients=include_test_patients)
+    practitioners = Practitioner.active_practitioners()
+
+    # group recipients by content; html is derived from the same values as text
+    groups = {}
+    for p in next_in_bundle(practitioners):
+        practitioner = Practitioner(p)
+        email_bits = _assemble_practitioner_email(
+            cfg=cfg,
+            practitioner=practitioner,
+            category=category,
+            filter_func=filter_func,
+            keeper_ids=keeper_ids,
+            skipper_ids=skipper_ids,
+            assemble_func=assemble_func,
+            patients_by_practitioner=patients_by_practitioner)
+        if email_bits is None:
+            continue
+        key = (email_bits["subject"], email_bits["text"])
+        groups.setdefault(key, (email_bits, []))[1].append(practitioner.email_address)
+
+    messages = [
+        dict(
+            recipient_emails=recipients[i:i + MAX_RECIPIENTS_PER_EMAIL],
+            subject=email_bits["subject"],
+            text=email_bits["text"],
+            html=email_bits["html"],
+            undisclosed_recipients=len(recipients) > 1)
+        for email_bits, recipients in groups.values()
+        for i in range(0, len(recipients), MAX_RECIPIENTS_PER_EMAIL)]
+    if not messages:
+        return
+
+    batch_count = min(max_workers, len(messages))
+    with ThreadPoolExecutor(max_workers=batch_count) as executor:
+        futures = [
+            executor.submit(
+                _send_practitioner_emails,
+                app=app,
+                messages=messages[i::batch_count],
+                dry_run=dry_run)
+            for i in range(batch_count)]
+        for future in as_completed(futures):
+            # raise any exception from the worker
+            future.result()
 
 
 def generate_outgoing_counts_emails(dry_run, include_test_patients):
@@ -143,10 +363,8 @@ def generate_outgoing_counts_emails(dry_run, include_test_patients):
     for every practitioner in the system, detailing the number of patients for which
     they have outgoing texts in the next 24 hours.
     """
-    now = datetime.now().astimezone()
+    now = local_now()
     cutoff = now + timedelta(days=1)
-    known_keepers.clear()
-    known_skippers.clear()
 
     def keep_patient_criteria(patient):
         """function passed to filter out which patients should be kept for this report"""
@@ -154,81 +372,71 @@ def generate_outgoing_counts_emails(dry_run, include_test_patients):
         if next_outgoing and next_outgoing.date > now and next_outgoing.date < cutoff:
             return True
 
-    practitioners = Practitioner.active_practitioners()
-    for p in next_in_bundle(practitioners):
-        practitioner = Practitioner(p)
-        practitioners_patients = practitioner.practitioner_patients(include_test_patients=include_test_patients)
-        outgoing = filter_patients(patients=practitioners_patients, filter_func=keep_patient_criteria)
-        if not outgoing:
-            logging.debug(f"no qualifying outgoing patients for {practitioner}")
-            continue
+    _dispatch_practitioner_emails(
+        category="outgoing",
+        filter_func=keep_patient_criteria,
+        assemble_func=assemble_outgoing_counts_email,
+        dry_run=dry_run,
+        include_test_patients=include_test_patients)
 
-        email_bits = assemble_outgoing_counts_email(practitioner, outgoing)
-        if not dry_run:
-            send_email(
-                recipient_emails=[practitioner.email_address],
-                subject=email_bits["subject"],
-                html=email_bits["html"],
-                text=email_bits["text"])
-        else:
-            click.echo(
-                f"email to: {practitioner.email_address}\n"
-                f"subject: {email_bits['subject']}\n"
-                f"body: {email_bits['text']}\n\n"
-                f"html: {email_bits['html']}\n\n"
-            )
 
+def last_unresponded(patient):
+    """Return datetime of patient's oldest unfollowed-up message
+
+    Uses the value stashed on the patient by the unresponded filter when
+    available, otherwise reads it from the patient's extension.
+    """
+    moment = getattr(patient, "_isacc_last_unresponded", None)
+    if moment is None:
+        moment = patient.get_extension(LAST_UNFOLLOWEDUP_URL, attribute="valueDateTime").date
+    return moment
 
 
-def assemble_unresponded_email(practitioner, patients):
+def assemble_unresponded_email(practitioner, patients, cfg=None, now=None):
     """Pull together email content for given practitioner and their list of patients
 
     :param practitioner: Practitioner object, target of email
     :param patients: list of Patient objects for whom the practitioner is assigned,
       expected to only include those with an un-responded message
+    :param cfg: config derived values from `email_config()`, looked up if not given
+    :param now: timezone aware time to measure message age from, typically the
+      start of the run; defaults to current time
     :return: email content
     """
-    SUPPORT_EMAIL = current_app.config.get('ISACC_SUPPORT_EMAIL')
-    UNSUB_LINK = f'{current_app.config.get("ISACC_APP_URL")}/unsubscribe'
-    patient_list_url = f'{current_app.config.get("ISACC_APP_URL")}/home?flags=following'
-    now = datetime.now().astimezone()
-    oldest_primary = now
-    oldest_secondary = now
-    primary, secondary = [], []
-    for p in patients:
-        moment = p.get_extension(LAST_UNFOLLOWEDUP_URL, attribute="valueDateTime").date
-        if p.generalPractitioner and p.generalPractitioner[0].reference == f"Practitioner/{practitioner.id}":
-            primary.append(p)
-            oldest_primary = min(oldest_primary, moment)
-            continue
-        secondary.append(p)
-        oldest_secondary = min(oldest_secondary, moment)
+    if cfg is None:
+        cfg = email_config()
+    patient_list_url = cfg.patient_list_unresponded
+    if now is None:
+        now = local_now()
+    primary, secondary = partition_by_primary(practitioner, patients)
+    oldest_primary = min([now, *(last_unresponded(p) for p in primary)])
+    oldest_secondary = min([now, *(last_unresponded(p) for p in secondary)])
 
     oldest_primary_days = (now - oldest_primary).days
     oldest_secondary_days = (now - oldest_secondary).days
     subject = f"ISACC {len(patients)} day old message/s are unanswered!"
-    contents = []
+    msg_parts = []
     if primary:
-        contents.append(f"There are {len(primary)} unanswered reply/ies for those who you are the primary author.")
-        contents.append(f"The oldest one is {oldest_primary_days} day/s old.")
+        msg_parts.append(f"There are {len(primary)} unanswered reply/ies for those who you are the primary author.")
+        msg_parts.append(f"The oldest one is {oldest_primary_days} day/s old.")
     if secondary:
-        contents.append(f"There are {len(secondary)} unanswered reply/ies for those whom you are following.")
-        contents.append(f"The oldest one is {oldest_secondary_days} day/s old.")
-    msg = " ".join(contents)
-    contents.append(f"Click here {patient_list_url} to get to the list of these outstanding messages from these people.")
-    contents.append("If you are not the person who should be getting these messages, contact your site lead.")
-    html = html_template.format(
+        msg_parts.append(f"There are {len(secondary)} unanswered reply/ies for those whom you are following.")
+        msg_parts.append(f"The oldest one is {oldest_secondary_days} day/s old.")
+    msg = " ".join(msg_parts)
+    text = " ".join((
+        msg,
+        f"Click here {patient_list_url} to get to the list of these outstanding messages from these people.",
+        "If you are not the person who should be getting these messages, contact your site lead."))
+    html = _render(
         pre_link_msg=msg,
         link_url=patient_list_url,
         link_suffix_text="to get to the list of these outstanding messages from these people",
-        post_link_msg=(
-            "If you are not the person who should be getting these messages, contact "
-            f'<a href="mailto:{SUPPORT_EMAIL}">your site lead</a>.'),
-        unsubscribe_link=UNSUB_LINK)
+        post_link_msg=cfg.site_lead_html,
+        unsubscribe_link=cfg.unsub_link)
 
     return {
         "subject": subject,
-        "text": " ".join(contents),
+        "text": text,
         "html": html}
 
 
@@ -242,36 +450,20 @@ def generate_unresponded_emails(dry_run, include_test_patients):
     for every practitioner in the system, detailing the number of patients for which
     they have un-responded texts and how long it has been, etc.
     """
-    cutoff = datetime.now().astimezone() - timedelta(days=1)
-    known_keepers.clear()
-    known_skippers.clear()
+    now = local_now()
+    cutoff = now - timedelta(days=1)
 
     def keep_patient_criteria(patient):
         """function passed to filter out which patients should be kept for this report"""
-        last_unresponded = patient.get_extension(LAST_UNFOLLOWEDUP_URL, attribute="valueDateTime")
-        if last_unresponded and last_unresponded.date < cutoff:
+        last_unfollowedup = patient.get_extension(LAST_UNFOLLOWEDUP_URL, attribute="valueDateTime")
+        if last_unfollowedup and last_unfollowedup.date < cutoff:
+            # stash for reuse in assemble_unresponded_email, see `last_unresponded()`
+            patient._isacc_last_unresponded = last_unfollowedup.date
             return True
 
-    practitioners = Practitioner.active_practitioners()
-    for p in next_in_bundle(practitioners):
-        practitioner = Practitioner(p)
-        practitioners_patients = practitioner.practitioner_patients(include_test_patients=include_test_patients)
-        unresponded = filter_patients(patients=practitioners_patients, filter_func=keep_patient_criteria)
-        if not unresponded:
-            logging.debug(f"no qualifying unresponded patients for {practitioner}")
-            continue
-
-        email_bits = assemble_unresponded_email(practitioner, unresponded)
-        if not dry_run:
-            send_email(
-                recipient_emails=[practitioner.email_address],
-                subject=email_bits["subject"],
-                html=email_bits["html"],
-                text=email_bits["text"])
-        else:
-            click.echo(
-                f"email to: {practitioner.email_address}\n"
-                f"subject: {email_bits['subject']}\n"
-                f"body: {email_bits['text']}\n\n"
-                f"html: {email_bits['html']}\n\n"
-            )
+    _dispatch_practitioner_emails(
+        category="unresponded",
+        filter_func=keep_patient_criteria,
+        assemble_func=partial(assemble_unresponded_email, now=now),
+        dry_run=dry_run,
+        include_test_patients=include_test_patients)
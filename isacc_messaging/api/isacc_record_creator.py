@@ -1,64 +1,201 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from flask import current_app
+from functools import lru_cache
+from itertools import islice
+import orjson
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+from time import monotonic
+from types import SimpleNamespace
 from typing import List, Tuple
 
 from fhirclient.models.communication import Communication
 from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
 
 from isacc_messaging.api.email_notifications import send_message_received_notification
 from isacc_messaging.audit import audit_entry
 from isacc_messaging.exceptions import IsaccTwilioSIDnotFound
 from isacc_messaging.models.fhir import (
+    HAPI_conditional_create,
     HAPI_request,
+    HAPI_transaction,
+    TTLCache,
     first_in_bundle,
     next_in_bundle,
+    prefetch_references,
     resolve_reference,
 )
-from isacc_messaging.models.isacc_communication import IsaccCommunication as Communication
-from isacc_messaging.models.isacc_communicationrequest import IsaccCommunicationRequest as CommunicationRequest
-from isacc_messaging.models.isacc_fhirdate import IsaccFHIRDate as FHIRDate
+from isacc_messaging.models.isacc_communication import (
+    CATEGORY_RECEIVED,
+    IsaccCommunication as Communication,
+    MEDIUM_SMSWRIT,
+)
+from isacc_messaging.models.isacc_communicationrequest import (
+    IsaccCommunicationRequest as CommunicationRequest,
+    OUTGOING_CATEGORIES,
+    TWILIO_SID_SYSTEM,
+)
+from isacc_messaging.models.isacc_fhirdate import local_now
 from isacc_messaging.models.isacc_patient import IsaccPatient as Patient
 from isacc_messaging.models.isacc_practitioner import IsaccPractitioner as Practitioner
 
 
-def expand_template_args(content: str, patient: Patient, practitioner: Practitioner) -> str:
-    """Interpolate any template args (i.e. {name}) in content"""
-    def preferred_name(resource, default=None):
-        # prefer given name with use category "usual"
-        if not resource:
-            return default
+# template args, matched regardless of case in a single pass
+_TEMPLATE_ARG_RE = re.compile(r"\{(name|username)\}", re.IGNORECASE)
+
 
-        for name in resource.name:
-            if name.use == "usual":
-                # UI cleared preferred names lose `given`
-                value = name.given and name.given[0]
-                if value:
-                    return value
+def _preferred_name(resource, default=None):
+    """Given name of resource, preferring one with use category "usual" """
+    if not resource:
+        return default
 
-        return resource.name[0].given[0]
+    for name in resource.name:
+        if name.use == "usual":
+            # UI cleared preferred names lose `given`
+            value = name.given and name.given[0]
+            if value:
+                return value
 
-    def case_insensitive_replace(text, old, new):
-        pattern = re.escape(old)
-        return re.sub(pattern, new, text, flags=re.IGNORECASE)
+    return resource.name[0].given[0]
 
-    c = case_insensitive_replace(content, "{name}", preferred_name(patient))
-    c = case_insensitive_replace(c, "{username}", preferred_name(practitioner, "Caring Contacts Team"))
-    return c
+
+def expand_template_args(content: str, patient: Patient, practitioner: Practitioner) -> str:
+    """Interpolate any template args (i.e. {name}) in content"""
+    if "{" not in content:
+        # no template args, the common case
+        return content
+
+    # names are only looked up for the args present, once each
+    lookups = {
+        "name": lambda: _preferred_name(patient),
+        "username": lambda: _preferred_name(practitioner, "Caring Contacts Team"),
+    }
+    values = {}
+
+    def replace(match):
+        arg = match.group(1).lower()
+        if arg not in values:
+            values[arg] = lookups[arg]()
+        return values[arg]
+
+    return _TEMPLATE_ARG_RE.sub(replace, content)
+
+
+# due CommunicationRequests read ahead at a time by `execute_requests`, for
+# bulk fetch of their patients and practitioners
+PREFETCH_BATCH_SIZE = 50
+
+# kept alive between calls to the ML service, see `score_message()`
+_ML_SESSION = requests.Session()
+_ML_SESSION.mount("http://", HTTPAdapter(pool_maxsize=16))
+_ML_SESSION.mount("https://", HTTPAdapter(pool_maxsize=16))
+# (connect, read) seconds; generous on read, as a timeout scores the
+# message routine, possibly missing an urgent one
+ML_SERVICE_TIMEOUT = (2, 10)
+# after this many consecutive failures, skip the ML service for a cooldown,
+# rather than have every inbound message wait out the timeout
+ML_SERVICE_MAX_FAILURES = 3
+ML_SERVICE_COOLDOWN = 30
+_ml_failures = 0
+_ml_cooldown_until = 0.0
+# guards the above, as dispatch and webhook threads score concurrently
+_ml_state_lock = threading.Lock()
+# acknowledgements scored routine without calling the ML service.  NB only
+# exact matches; short messages in general may well be urgent
+_TRIVIAL_REPLIES = frozenset((
+    "", "ok", "okay", "k", "kk", "yes", "yep", "yeah", "y", "sure",
+    "thanks", "thank you", "thx", "ty", "got it", "sounds good",
+    "👍", "🙂", "😊",
+))
+
+# active patient ids keyed by phone number, sparing the search on repeat senders
+_patient_id_by_phone = TTLCache(maxsize=4096)
+PATIENT_BY_PHONE_TTL = 3600
+
+
+def active_patient_by_phone(phone):
+    """Lookup active patient with given phone number
+
+    Only the patient id is cached; the patient itself is read fresh, not
+    from `resource_cache`, as callers may write it back (i.e. on STOP).
+    The match is confirmed still active and holding the phone number
+    before use, as either may have been changed since.
+
+    :param phone: phone number, without country code, as stored in telecom
+    :return: Patient, or None if no active patient has the phone number
+    """
+    patient_id = _patient_id_by_phone.get(phone)
+    if patient_id is not None:
+        try:
+            pt = Patient(HAPI_request('GET', 'Patient', resource_id=patient_id))
+        except ValueError:
+            # patient since removed, fall back to search
+            pt = None
+        if pt and pt.active and any(t.value == phone for t in (pt.telecom or ())):
+            return pt
+        _patient_id_by_phone.pop(phone)
+
+    pt = first_in_bundle(HAPI_request('GET', 'Patient', params={
+        "telecom": phone,
+        "active": "true",
+        "_count": 1,
+    }))
+    if not pt:
+        return
+    pt = Patient(pt)
+    _patient_id_by_phone.set(phone, pt.id, PATIENT_BY_PHONE_TTL)
+    return pt
+
+
+# seconds; the client otherwise waits indefinitely, holding a dispatch worker
+TWILIO_TIMEOUT = 30
+
+
+@lru_cache(maxsize=1)
+def _twilio(app):
+    """Twilio Client and send parameters for given app, built once
+
+    The client is reused to keep its API connections warm.
+
+    :param app: Flask app, also serving as the cache key
+    """
+    http_client = TwilioHttpClient(timeout=TWILIO_TIMEOUT)
+    # the default pool may be smaller than the dispatch workers sharing it,
+    # see `execute_requests()`.  NB no retries, a repeated POST may send twice
+    http_client.session.mount("https://", HTTPAdapter(
+        pool_maxsize=int(app.config.get("ISACC_DISPATCH_CONCURRENCY", 8))))
+    return SimpleNamespace(
+        client=Client(
+            app.config.get('TWILIO_ACCOUNT_SID'),
+            app.config.get('TWILIO_AUTH_TOKEN'),
+            http_client=http_client),
+        from_phone=app.config.get('TWILIO_PHONE_NUMBER'),
+        status_callback=app.config.get('TWILIO_WEBHOOK_CALLBACK') + '/MessageStatus',
+    )
 
 
 class IsaccRecordCreator:
     def __init__(self):
         pass
 
-    def dispatch_cr(self, cr: CommunicationRequest):
+    def dispatch_cr(self, cr: CommunicationRequest, patient: Patient = None):
+        """Send SMS for given CommunicationRequest
+
+        :param cr: CommunicationRequest to dispatch
+        :param patient: recipient, if already at hand; resolved when not given
+        """
         if cr.dispatched():
             return cr.dispatched_message_status()
         status = ""
         statusReason = ""
-        target_phone = resolve_reference(cr.recipient[0].reference).get_phone_number()
-        patient = resolve_reference(cr.recipient[0].reference)
+        if patient is None:
+            patient = resolve_reference(cr.recipient[0].reference)
+        target_phone = patient.get_phone_number()
         try:
             if not patient.generalPractitioner:
                 practitioner=None
@@ -107,21 +244,15 @@ class IsaccRecordCreator:
             return status, statusReason
 
     def send_twilio_sms(self, message, to_phone, from_phone=None):
-        from twilio.rest import Client
-        account_sid = current_app.config.get('TWILIO_ACCOUNT_SID')
-        auth_token = current_app.config.get('TWILIO_AUTH_TOKEN')
+        twilio = _twilio(current_app._get_current_object())
         if from_phone is None:
-            from_phone = current_app.config.get('TWILIO_PHONE_NUMBER')
+            from_phone = twilio.from_phone
 
-        webhook_callback = current_app.config.get('TWILIO_WEBHOOK_CALLBACK')
-
-        client = Client(account_sid, auth_token)
-
-        message = client.messages.create(
+        message = twilio.client.messages.create(
             body=message,
             from_=from_phone,
             to=to_phone,
-            status_callback=webhook_callback + '/MessageStatus'
+            status_callback=twilio.status_callback
             # ,media_url=['https://demo.twilio.com/owl.png']
         )
         audit_entry(
@@ -142,9 +273,9 @@ class IsaccRecordCreator:
         if patient is None:
             raise ValueError("Missing active patient")
 
-        care_plan = patient.get_careplan()
+        care_plan_id = patient.get_careplan_id()
 
-        if not care_plan:
+        if not care_plan_id:
             error = "No CarePlan for this patient:"
             audit_entry(
                 error,
@@ -154,21 +285,19 @@ class IsaccRecordCreator:
             return f"{error}: Patient/{patient.id}"
 
         if time is None:
-            time = datetime.now()
+            time = local_now()
 
         if themes is None:
             themes = []
 
-        message_time = time.astimezone().isoformat()
+        message_time = (time if time.tzinfo else time.astimezone()).isoformat()
         m = {
             'resourceType': 'Communication',
-            'identifier': [{"system": "http://isacc.app/twilio-message-sid", "value": twilio_sid}],
-            'partOf': [{'reference': f'CarePlan/{care_plan.id}'}],
+            'identifier': [{"system": TWILIO_SID_SYSTEM, "value": twilio_sid}],
+            'partOf': [{'reference': f'CarePlan/{care_plan_id}'}],
             'status': 'completed',
-            'category': [{'coding': [{'system': 'https://isacc.app/CodeSystem/communication-type',
-                                      'code': 'isacc-received-message'}]}],
-            'medium': [{'coding': [{'system': 'http://terminology.hl7.org/ValueSet/v3-ParticipationMode',
-                                    'code': 'SMSWRIT'}]}],
+            'category': CATEGORY_RECEIVED,
+            'medium': MEDIUM_SMSWRIT,
             'sent': message_time,
             'sender': {'reference': f'Patient/{patient.id}'},
             'payload': [{'contentString': message}],
@@ -196,7 +325,8 @@ class IsaccRecordCreator:
         message_status = values.get('MessageStatus', None)
 
         cr = HAPI_request('GET', 'CommunicationRequest', params={
-            "identifier": f"http://isacc.app/twilio-message-sid|{message_sid}"
+            "identifier": f"{TWILIO_SID_SYSTEM}|{message_sid}",
+            "_count": 1,
         })
         cr = first_in_bundle(cr)
         if cr is None:
@@ -209,39 +339,34 @@ class IsaccRecordCreator:
             raise IsaccTwilioSIDnotFound(f"ERROR! {error}: {message_sid}")
 
         cr = CommunicationRequest(cr)
-        patient = resolve_reference(cr.recipient[0].reference)
 
         # update the message status in the identifier/extension attributes
-        for i in cr.identifier:
-            if i.system == "http://isacc.app/twilio-message-sid" and i.value == message_sid:
-                for e in i.extension:
-                    if e.url == "http://isacc.app/twilio-message-status":
-                        e.valueCode = message_status
-                    if e.url == "http://isacc.app/twilio-message-status-updated":
-                        e.valueDateTime = FHIRDate(datetime.now().astimezone().isoformat())
+        status_patch = cr.update_twilio_status(message_sid, message_status)
+        if not status_patch:
+            audit_entry(
+                "Twilio SID missing from CommunicationRequest identifiers",
+                extra={"message_sid": message_sid, "resource": f"{cr}"},
+                level='warn'
+            )
 
         # sometimes we go straight to delivered. other times we go to sent and then delivered. sometimes we go to sent
         # and never delivered (it has been delivered but we don't get a callback with that status)
         if message_status == 'sent' or message_status == 'delivered':
-            existing_comm = first_in_bundle(HAPI_request('GET', 'Communication', params={
-                'based-on': f"CommunicationRequest/{cr.id}"
-            }))
-            if existing_comm is None:
-                # Callback only occurs on completed Communications
-                comm_json = cr.create_communication_from_request(status="completed")
-                comm = Communication(comm_json)
-                new_comm = HAPI_request('POST', 'Communication', resource=comm.as_json())
+            # Callback only occurs on completed Communications; conditional
+            # create returns the existing Communication rather than a duplicate
+            created, comm_json = HAPI_conditional_create(
+                'Communication',
+                resource=cr.create_communication_from_request(status="completed"),
+                condition=f"based-on=CommunicationRequest/{cr.id}")
+            if created:
                 audit_entry(
                     f"Created Communication resource on Twilio callback:",
-                    extra={"resource": new_comm},
+                    extra={"resource": comm_json},
                     level='debug'
                 )
-                # if this was a manual message, mark patient as having been followed up with
-                if comm.is_manual_follow_up_message():
-                    patient.mark_followup_extension()
             else:
                 # Update the status of the communication to completed
-                comm = Communication(existing_comm)
+                comm = Communication(comm_json)
                 comm.change_status(status="completed")
                 audit_entry(
                     f"Received /MessageStatus callback with status {message_status} on existing Communication resource",
@@ -251,24 +376,25 @@ class IsaccRecordCreator:
                 )
 
             cr.status = "completed"
-            updated_cr = cr.persist()
+            updated_cr = HAPI_request('PATCH', 'CommunicationRequest', resource_id=cr.id, resource=[
+                *status_patch, {"op": "replace", "path": "/status", "value": "completed"}])
 
             audit_entry(
                 f"Updated CommunicationRequest and Communication due to twilio status update:",
-                extra={"resource": f"CR: {updated_cr} \n Comm: {existing_comm}"},
+                extra={"resource": f"CR: {updated_cr} \n Comm: {comm_json}"},
                 level='debug'
             )
 
             # maintain next outgoing and last followed up Twilio message
-            # extensions after each send (now know to be complete)
+            # extensions after each send (now know to be complete), including
+            # marking the patient followed up with on a manual message.
+            # read fresh, as a stale copy may match the new value, skipping
+            # the write
+            patient = resolve_reference(cr.recipient[0].reference, fresh=True)
             patient.mark_followup_extension()
 
     def on_twilio_message_received(self, values):
-        pt = HAPI_request('GET', 'Patient', params={
-            "telecom": values.get("From", "+1").replace("+1", ""),
-            "active": "true",
-        })
-        pt = first_in_bundle(pt)
+        pt = active_patient_by_phone(values.get("From", "").removeprefix("+1"))
         if not pt:
             error = "No active patient with this phone number"
             phone = values.get('From')
@@ -278,13 +404,13 @@ class IsaccRecordCreator:
                 level='error'
             )
             return f"{error}: {phone}"
-        pt = Patient(pt)
 
         message = values.get("Body")
-        if message.lower().strip() == "stop":
+        command = message.strip().lower()
+        if command == "stop":
             # if the user requested to unsubscribe, mark patient as inactive
             pt.unsubscribe()
-        elif message.lower().strip() == "start":
+        elif command == "start":
             # if the user requested to resubscribe, mark patient as active
             pt.subscribe()
 
@@ -292,30 +418,53 @@ class IsaccRecordCreator:
 
         return self.generate_incoming_message(
             message=message,
-            time=datetime.now(),
+            time=local_now(),
             twilio_sid=values.get('SmsSid'),
             patient=pt,
             priority=message_priority
         )
 
     def score_message(self, message):
+        global _ml_failures, _ml_cooldown_until
         ml_service_address = current_app.config.get('ML_SERVICE_ADDRESS')
         if not ml_service_address:
             return "routine"
+        if message.strip(" \t\n.!").lower() in _TRIVIAL_REPLIES:
+            return "routine"
+        with _ml_state_lock:
+            cooling_down = monotonic() < _ml_cooldown_until
+        if cooling_down:
+            audit_entry(
+                "Skipped message urgency assessment, ML service cooling down",
+                level='warn'
+            )
+            return "routine"
 
         try:
             url = f'{ml_service_address}/predict_score'
-            response = requests.post(url, json={"message": message})
+            response = _ML_SESSION.post(
+                url,
+                data=orjson.dumps({"message": message}),
+                headers={"Content-Type": "application/json"},
+                timeout=ML_SERVICE_TIMEOUT)
             response.raise_for_status()
+            result = orjson.loads(response.content)
             audit_entry(
-                f"predict_score call response: {response.json()}",
+                f"predict_score call response: {result}",
                 level='info'
             )
 
-            score = response.json().get('score')
+            with _ml_state_lock:
+                _ml_failures = 0
+            score = result.get('score')
             if score == 1:
                 return "stat"
         except Exception as e:
+            with _ml_state_lock:
+                _ml_failures += 1
+                if _ml_failures >= ML_SERVICE_MAX_FAILURES:
+                    _ml_failures = 0
+                    _ml_cooldown_until = monotonic() + ML_SERVICE_COOLDOWN
             audit_entry(
                 "Failed to assess message urgency",
                 extra={"exception": e},
@@ -323,110 +472,198 @@ class IsaccRecordCreator:
             )
         return "routine"
 
+    def execute_request(self, cr_json: dict, cutoff: datetime) -> Tuple[bool, dict, dict]:
+        """Generate SMS, create Communication resource, and update given CommunicationRequest
+
+        :param cr_json: JSON of due CommunicationRequest
+        :param cutoff: CommunicationRequests scheduled prior are revoked rather than sent
+
+        NB the patient's next outgoing extension is left for the caller to
+        update, see `execute_requests()`
+
+        :return: tuple (dispatched, success, error); dispatched is true when a
+          send was attempted, success and error are report dicts or None
+        """
+        cr = CommunicationRequest(cr_json)
+        patient = resolve_reference(cr.recipient[0].reference)
+
+        # Do not interact with CR if the patient is inactive or sending date is past the cutoff
+        if not patient.active or cr.occurrenceDateTime.date < cutoff:
+            cr.status = "revoked"
+            cr.persist()
+            revoked_reason = "Past the cutoff"
+            if not patient.active:
+                revoked_reason = "Recipient is not active"
+            cr.report_cr_status(status_reason=revoked_reason)
+            return False, None, {'id': cr.id, 'error': revoked_reason}
+
+        # Already sent (i.e. reactivated after dispatch); complete without
+        # creating another Communication
+        if cr.dispatched():
+            status_reason = cr.dispatched_message_status()
+            cr.status = "completed"
+            cr.persist()
+            cr.report_cr_status(status_reason=status_reason)
+            return False, None, {'id': cr.id, 'error': status_reason}
+
+        # If patient unsubscribed, record a stopped communication
+        if patient.is_unsubscribed:
+            cr.status = "revoked"
+            comm_json = cr.create_communication_from_request(status="stopped")
+            comm_ref, _ = HAPI_transaction(("POST", comm_json), ("PUT", cr.as_json()))
+            audit_entry(
+                f"Generated {comm_ref} for CommunicationRequest/{cr.id}, "
+                f"with status stopped, because patient unsubscribed",
+                extra={"new Communication": comm_json},
+                level='debug'
+            )
+            return False, None, {'id': cr.id, 'error': "Patient unsubscribed"}
+
+        # Otherwise, create a communication, completing the request ahead of
+        # dispatch so it can't be sent twice
+        comm_json = cr.create_communication_from_request(status="in-progress")
+        cr.status = "completed"
+        comm_ref, _ = HAPI_transaction(("POST", comm_json), ("PUT", cr.as_json()))
+        comm = Communication({**comm_json, "id": comm_ref.split('/')[1]})
+        # context gathered for a single audit entry on the outcome
+        audit_ctx = {"new Communication": comm_ref}
+
+        # update according to the feedback from the dispatch
+        success, error = None, None
+        try:
+            comm_status, comm_statusReason = self.process_cr(cr, patient=patient)
+            dispatched_comm = comm.change_status(status=comm_status)
+            audit_ctx.update({"dispatched Communication": dispatched_comm, "statusReason": comm_statusReason})
+            if comm_status == "in-progress":
+                # In-progress status entails that sms was successfully dispatched
+                audit_entry(
+                    f"Generated Communication/{comm.id} for CommunicationRequest/{cr.id}, "
+                    f"updated status to {comm_status}",
+                    extra=audit_ctx,
+                    level='debug'
+                )
+                success = {'id': cr.id, 'status': comm_statusReason}
+            else:
+                # Register an error encountered when sending a message
+                audit_entry(
+                    f"Failed to send the message for CommunicationRequest/{cr.id} because {comm_statusReason}",
+                    extra=audit_ctx,
+                    level='exception'
+                )
+                error = {'id': cr.id, 'error': comm_statusReason}
+
+        except Exception as e:
+            cr.status = "revoked"
+            # Register an error when sending a message
+            comm.status = "unknown"
+            HAPI_transaction(("PUT", cr.as_json()), ("PUT", comm.as_json()))
+            audit_entry(
+                f"Failed to send the message for CommunicationRequest/{cr.id} because {e}",
+                extra={**audit_ctx, "resource": f"Communication/{comm.id}", "statusReason": e},
+                level='exception'
+            )
+        return True, success, error
+
     def execute_requests(self) -> Tuple[List[dict], List[dict]]:
         """
         For all due CommunicationRequests (up to throttle limit), generate SMS, create Communication resource, and update CommunicationRequest
+
+        Each request is I/O bound (FHIR store and Twilio round trips), so
+        requests are executed concurrently by ``ISACC_DISPATCH_CONCURRENCY``
+        worker threads.  Requests for the same patient are serialized, as
+        each updates the patient's extensions.
         """
         successes = []
         errors = []
         throttle_limit = 30  # conservative value based on heuristics from logs
-        now = datetime.now().astimezone()
+        now = local_now()
         cutoff = now - timedelta(days=2)
+        app = current_app._get_current_object()
+        max_workers = int(current_app.config.get("ISACC_DISPATCH_CONCURRENCY", 8))
 
         result = HAPI_request('GET', 'CommunicationRequest', params={
-            "category": "isacc-scheduled-message,isacc-manually-sent-message",
+            "category": OUTGOING_CATEGORIES,
             "status": "active",
             "occurrence": f"le{now.isoformat()}",
+            # page size matching the read ahead; further pages are only
+            # fetched by `next_in_bundle` as the throttle permits
+            "_count": PREFETCH_BATCH_SIZE,
         })
-
-        sent = 0
-        for cr_json in next_in_bundle(result):
-            cr = CommunicationRequest(cr_json)
-            patient = resolve_reference(cr.recipient[0].reference)
-
-            # Do not interact with CR if the patient is inactive or sending date is past the cutoff
-            if not patient.active or cr.occurrenceDateTime.date < cutoff:
-                cr.status = "revoked"
-                cr.persist()
-                revoked_reason = "Past the cutoff"
-                if not patient.active:
-                    revoked_reason = "Recipient is not active"
-                cr.report_cr_status(status_reason=revoked_reason)
-                errors.append({'id': cr.id, 'error': revoked_reason})
-                patient.mark_next_outgoing()  # update given state change
-                continue
-
-            # Otherwise, create a communication
-            comm_json = cr.create_communication_from_request(status="in-progress")
-            updated_comm = HAPI_request('POST', 'Communication', resource=comm_json)
-            comm = Communication(updated_comm)
-            audit_entry(
-                f"Generated an {comm.status} Communication/{comm.id} for CommunicationRequest/{cr.id}",
-                extra={"new Communication": updated_comm},
-                level="debug"
-            )
-
-            # If patient unsubscribed, mark as stopped
-            if any(
-                telecom_entry.system.lower() == 'sms' and telecom_entry.period.end
-                for telecom_entry in getattr(patient, 'telecom', [])
-            ):
-                cr.status = "revoked"
-                cr.persist()
-                stopped_comm = comm.change_status(status="stopped")
-                errors.append({'id': cr.id, 'error': "Patient unsubscribed"})
-                audit_entry(
-                    f"Updated {comm} to {comm.status}, because patient unsubscribed",
-                    extra={"Updated Communication": stopped_comm},
-                    level='debug'
-                )
-                patient.mark_next_outgoing()  # update given state change
-                continue
-
-            # Otherwise, update according to the feedback from the dispatch
-            try:
-                cr.status = "completed"
-                cr.persist()
-                comm_status, comm_statusReason = self.process_cr(cr)
-                dispatched_comm = comm.change_status(status=comm_status)
-                audit_entry(
-                    f"Updated status of Communication/{comm.id} to {comm_status}",
-                    extra={"dispatched Communication": dispatched_comm, "statusReason": comm_statusReason},
-                    level='debug'
-                )
-                if comm_status == "in-progress":
-                    # In-progress status entails that sms was successfully dispatched
-                    successes.append({'id': cr.id, 'status': comm_statusReason})
-                else:
-                    # Register an error encountered when sending a message
+        if result.get('total') == 0:
+            # nothing due; skip worker setup
+            return successes, errors
+        due = next_in_bundle(result)
+        prefetched = []
+
+        def next_due():
+            """Next due CR JSON, prefetching patients for those that follow"""
+            if not prefetched:
+                prefetched.extend(islice(due, PREFETCH_BATCH_SIZE))
+                prefetch_references(
+                    {cr_json['recipient'][0]['reference'] for cr_json in prefetched},
+                    include="Patient:general-practitioner")
+            return prefetched.pop(0) if prefetched else None
+
+        def execute(cr_json, patient_lock):
+            with app.app_context(), patient_lock:
+                return self.execute_request(cr_json, cutoff)
+
+        def mark_next_outgoing(patient_ref):
+            with app.app_context():
+                try:
+                    # read fresh, see `on_twilio_message_status_update()`
+                    resolve_reference(patient_ref, fresh=True).mark_next_outgoing()
+                except Exception as e:
                     audit_entry(
-                        f"Failed to send the message for CommunicationRequest/{cr.id} because {comm_statusReason}",
-                        extra={"Dispatched Communication": dispatched_comm, "statusReason": comm_status},
+                        f"Failed to update next outgoing for {patient_ref} because {e}",
+                        extra={"resource": patient_ref, "exception": e},
                         level='exception'
                     )
-                    errors.append({'id': cr.id, 'error': comm_statusReason})
-
-            except Exception as e:
-                cr.status = "revoked"
-                cr.persist()
-                # Register an error when sending a message
-                comm.change_status(status="unknown")
-                audit_entry(
-                    f"Failed to send the message for CommunicationRequest/{cr.id} because {e}",
-                    extra={"resource": f"Communication/{comm.id}", "statusReason": e},
-                    level='exception'
-                )
-            patient.mark_next_outgoing()  # update given state change
 
-            # Flooding system on occasions such as a holiday message to all,
-            # leads to an overwhelmed system.  Restrict the flood by processing
-            # only throttle_limit per run.
-            sent += 1
-            if sent > throttle_limit:
-                break
+        patient_locks = {}
+        pending = {}
+        sent = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                # Flooding system on occasions such as a holiday message to all,
+                # leads to an overwhelmed system.  Restrict the flood by processing
+                # only throttle_limit per run, counting those in flight as sent.
+                while len(pending) < max_workers and sent + len(pending) <= throttle_limit:
+                    cr_json = next_due()
+                    if cr_json is None:
+                        break
+                    patient_lock = patient_locks.setdefault(
+                        cr_json['recipient'][0]['reference'], threading.Lock())
+                    pending[executor.submit(execute, cr_json, patient_lock)] = cr_json['id']
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cr_id = pending.pop(future)
+                    try:
+                        dispatched, success, error = future.result()
+                    except Exception as e:
+                        audit_entry(
+                            f"Failed to execute CommunicationRequest/{cr_id} because {e}",
+                            extra={"resource": f"CommunicationRequest/{cr_id}", "exception": e},
+                            level='exception'
+                        )
+                        errors.append({'id': cr_id, 'error': str(e)})
+                        continue
+                    if dispatched:
+                        sent += 1
+                    if success:
+                        successes.append(success)
+                    if error:
+                        errors.append(error)
+
+            # state changed for each patient with an executed request; update
+            # once per patient rather than after each of their requests
+            list(executor.map(mark_next_outgoing, patient_locks))
 
         return successes, errors
 
-    def process_cr(self, cr: CommunicationRequest):
-        status, statusReason = self.dispatch_cr(cr=cr)
+    def process_cr(self, cr: CommunicationRequest, patient: Patient = None):
+        status, statusReason = self.dispatch_cr(cr=cr, patient=patient)
         return status, statusReason
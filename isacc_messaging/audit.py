@@ -7,10 +7,22 @@ from flask import current_app, has_app_context
 import json
 import logging
 
-from isacc_messaging.logserverhandler import LogServerHandler
+from isacc_messaging.logserverhandler import BufferedLogServerHandler, LogServerHandler
 
 EVENT_LOG_NAME = "isacc_messaging_event_logger"
 
+# numeric level for each `audit_entry()` level name
+_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARNING,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'exception': logging.ERROR,
+    'critical': logging.CRITICAL,
+    'fatal': logging.CRITICAL,
+}
+
 
 def audit_log_init(app):
     log_server_handler = LogServerHandler(
@@ -18,7 +30,15 @@ def audit_log_init(app):
         url=app.config['LOGSERVER_URL'])
     event_logger = logging.getLogger(EVENT_LOG_NAME)
     event_logger.setLevel(logging.INFO)
-    event_logger.addHandler(log_server_handler)
+    # replace any handler from a previous app (i.e. tests), stopping its thread
+    for handler in list(event_logger.handlers):
+        if isinstance(handler, BufferedLogServerHandler):
+            event_logger.removeHandler(handler)
+            handler.close()
+    event_logger.addHandler(BufferedLogServerHandler(
+        target=log_server_handler,
+        capacity=app.config['AUDIT_BUFFER_SIZE'],
+        flush_interval=app.config['AUDIT_FLUSH_INTERVAL']))
 
 
 def audit_entry(message, level='info', extra=None):
@@ -29,6 +49,10 @@ def audit_entry(message, level='info', extra=None):
     except AttributeError:
         raise ValueError(f"audit_entry given bogus level: {level}")
 
+    # skip encoding extra for entries the logger would only discard
+    if not logger.isEnabledFor(_LEVELS.get(level.lower(), logging.NOTSET)):
+        return
+
     if extra is None:
         extra = {}
 
@@ -10,6 +10,10 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 # URL scheme to use outside of request context
 PREFERRED_URL_SCHEME = os.getenv("PREFERRED_URL_SCHEME", 'http')
 FHIR_URL = os.getenv("FHIR_URL")
+# seconds to cache FHIR resources read by reference (and CarePlan lookups); 0 disables
+FHIR_CACHE_TTL = int(os.getenv("FHIR_CACHE_TTL", 30))
+# seconds to cache a patient's active CarePlan id, for linking incoming messages
+CAREPLAN_ID_CACHE_TTL = int(os.getenv("CAREPLAN_ID_CACHE_TTL", 300))
 SESSION_TYPE = os.getenv("SESSION_TYPE", 'redis')
 SESSION_REDIS = redis.from_url(os.getenv("SESSION_REDIS", "redis://127.0.0.1:6379"))
 
@@ -18,6 +22,11 @@ REQUEST_CACHE_EXPIRE = 24 * 60 * 60  # 24 hours
 
 LOGSERVER_TOKEN = os.getenv('LOGSERVER_TOKEN')
 LOGSERVER_URL = os.getenv('LOGSERVER_URL')
+# audit entries are submitted to logserver in batches of up to AUDIT_BUFFER_SIZE,
+# at least every AUDIT_FLUSH_INTERVAL seconds, always from a background thread;
+# errors wake that thread for a prompt flush, but are not delivered synchronously
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', 100))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 5))
 
 # NB log level hardcoded at INFO for logserver
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
@@ -40,3 +49,9 @@ MAIL_SUPPRESS_SEND = os.getenv("MAIL_SUPPRESS_SEND", 'false').lower() == 'true'
 ISACC_APP_URL = os.getenv("ISACC_APP_URL")
 EMAIL_PORT = os.getenv("EMAIL_PORT", 465)
 EMAIL_SERVER = os.getenv("EMAIL_SERVER", "smtp.gmail.com")
+# number of SMTP connections sending batches of system emails concurrently
+ISACC_EMAIL_CONCURRENCY = int(os.getenv("ISACC_EMAIL_CONCURRENCY", 5))
+# number of due CommunicationRequests to execute concurrently
+ISACC_DISPATCH_CONCURRENCY = int(os.getenv("ISACC_DISPATCH_CONCURRENCY", 8))
+# send message received notifications from a background thread, off the request path
+ISACC_NOTIFICATION_ASYNC = os.getenv("ISACC_NOTIFICATION_ASYNC", 'true').lower() == 'true'
@@ -1,8 +1,12 @@
+import atexit
 import json
 import logging
+from logging.handlers import MemoryHandler
 from pythonjsonlogger.jsonlogger import JsonFormatter
 import requests
 from requests.exceptions import RequestException
+import threading
+import weakref
 
 
 class LogServerHandler(logging.Handler):
@@ -12,21 +16,99 @@ class LogServerHandler(logging.Handler):
         super().__init__()
         self.jwt = jwt
         self.url = f"{url}/events"
+        self.session = requests.Session()
         self.setFormatter(JsonFormatter(
             "%(asctime)s %(name)s %(levelname)s %(message)s"))
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        log_entry = {"event": json.loads(log_entry)}
+    def event(self, record):
+        """Format record as logserver event"""
+        return {"event": json.loads(self.format(record))}
+
+    def post(self, payload):
+        """POST payload (a single event or list of events) to logserver"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.jwt}"
         }
         try:
-            response = requests.post(url=self.url, headers=headers, json=log_entry)
+            response = self.session.post(url=self.url, headers=headers, json=payload)
             response.raise_for_status()
         except RequestException as ex:
             # bootstrap problems - attempt to log to root logger
             root_logger = logging.getLogger('root')
             root_logger.error("error submitting message to logserver: %s", self.url)
             root_logger.exception(ex)
+
+    def emit(self, record):
+        self.post(self.event(record))
+
+    def emit_batch(self, records):
+        """Submit several records to logserver in a single request"""
+        self.post([self.event(record) for record in records])
+
+
+# BufferedLogServerHandlers not yet closed, closed (with a final flush) at exit
+_open_handlers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_handlers():
+    for handler in list(_open_handlers):
+        handler.close()
+
+
+class BufferedLogServerHandler(MemoryHandler):
+    """Buffers records for a LogServerHandler, submitting them in batches
+
+    Buffered records are flushed from a background thread every
+    `flush_interval` seconds, promptly once `capacity` are held or on any
+    record at ERROR or above, and at exit.  Logging threads never wait on
+    the logserver request.
+
+    `close()` stops the background thread; see `audit_log_init()`.
+    """
+
+    # seconds `close()` waits on a flush already underway
+    CLOSE_TIMEOUT = 10
+
+    def __init__(self, target, capacity, flush_interval):
+        super().__init__(capacity, flushLevel=logging.ERROR, target=target)
+        self._stopped = threading.Event()
+        self._flush_requested = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically,
+            args=(flush_interval,),
+            name="logserver-flush",
+            daemon=True)
+        self._flusher.start()
+        _open_handlers.add(self)
+
+    def _flush_periodically(self, interval):
+        while not self._stopped.is_set():
+            self._flush_requested.wait(interval)
+            self._flush_requested.clear()
+            self.flush()
+
+    def emit(self, record):
+        # as MemoryHandler, but hand the flush to the background thread
+        self.buffer.append(record)
+        if self.shouldFlush(record):
+            self._flush_requested.set()
+
+    def flush(self):
+        # swap out the buffer under lock, posting outside it so loggers
+        # aren't held up by the request
+        with self.lock:
+            records, self.buffer = self.buffer, []
+            target = self.target
+        if records and target:
+            target.emit_batch(records)
+
+    def close(self):
+        # stop the background thread before the final flush
+        self._stopped.set()
+        self._flush_requested.set()
+        if self._flusher is not threading.current_thread():
+            self._flusher.join(timeout=self.CLOSE_TIMEOUT)
+        _open_handlers.discard(self)
+        super().close()
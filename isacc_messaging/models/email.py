@@ -1,27 +1,243 @@
 """Module for email utility functions"""
-from email import utils
+import atexit
+from contextlib import contextmanager
+from email import policy, utils
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from flask import current_app
+from functools import lru_cache
+import hashlib
+import queue
 import smtplib
 import ssl
+import threading
+import time
+from types import SimpleNamespace
 
 from isacc_messaging.audit import audit_entry
 
+# recycle pooled connections after this many messages or seconds idle
+SMTP_POOL_MAX_MESSAGES = 100
+SMTP_POOL_MAX_IDLE = 60
 
-def send_email(recipient_emails: list, subject, text, html):
-    """Utility function to send given email"""
-    port = current_app.config.get('EMAIL_PORT')  # For SSL
-    email_server = current_app.config.get('EMAIL_SERVER')
-    sender_email = current_app.config.get('ISACC_NOTIFICATION_EMAIL_SENDER_ADDRESS')
-    app_password = current_app.config.get('ISACC_NOTIFICATION_EMAIL_PASSWORD')
-    sender_name = current_app.config.get('ISACC_NOTIFICATION_EMAIL_SENDER_NAME')
+@lru_cache(maxsize=1)
+def _smtp_cfg(app):
+    """SMTP and sender config values, read once per app
+
+    :param app: Flask app, also serving as the cache key, so a new app (or
+      `_smtp_cfg.cache_clear()`) picks up config changes
+    """
+    return SimpleNamespace(
+        server=app.config.get('EMAIL_SERVER'),
+        port=app.config.get('EMAIL_PORT'),  # For SSL
+        sender_address=app.config.get('ISACC_NOTIFICATION_EMAIL_SENDER_ADDRESS'),
+        password=app.config.get('ISACC_NOTIFICATION_EMAIL_PASSWORD'),
+        sender_name=app.config.get('ISACC_NOTIFICATION_EMAIL_SENDER_NAME'),
+        unsubscribe_url=f"{app.config.get('ISACC_APP_URL')}/unsubscribe",
+        suppress_send=app.config.get('MAIL_SUPPRESS_SEND'),
+    )
+
+
+def smtp_config():
+    """Return SMTP config values for the current app, see `_smtp_cfg()`"""
+    return _smtp_cfg(current_app._get_current_object())
+
+
+# serialize with CRLF line endings, as required on the wire, so messages
+# are handed to smtplib as bytes ready to send
+_SMTP_POLICY = policy.compat32.clone(linesep="\r\n")
+
+# built once, as loading the trust store is costly; shared by all connections
+_SSL_CONTEXT = ssl.create_default_context()
+
+# most recent TLS session per (server, port), for resumption on reconnect
+_tls_sessions: dict[tuple, ssl.SSLSession] = {}
+
+
+class ResumingSMTP_SSL(smtplib.SMTP_SSL):
+    """SMTP_SSL able to resume a previous TLS session, skipping a full handshake
+
+    :param session: optional `ssl.SSLSession` from an earlier connection to
+      the same server, as available from ``sock.session``
+    """
+
+    def __init__(self, *args, session=None, **kwargs):
+        # must be set prior to base init, which connects when given a host
+        self.tls_session = session
+        super().__init__(*args, **kwargs)
+
+    def _get_socket(self, host, port, timeout):
+        sock = smtplib.SMTP._get_socket(self, host, port, timeout)
+        return self.context.wrap_socket(
+            sock, server_hostname=self._host, session=self.tls_session)
+
+
+class SMTPConnection:
+    """Lazily opened SMTP connection, reusable across several `send_email` calls
+
+    The TLS handshake and login dominate the cost of sending a single email.
+    Holding one connection open for a batch of emails pays that cost once.
+    The connection is confirmed alive via NOOP prior to each use, and
+    reopened if the server has dropped it.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.address = None
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    def expired(self):
+        """True if connection should be recycled, given use and idle time"""
+        return (
+            self.messages_sent >= SMTP_POOL_MAX_MESSAGES or
+            time.monotonic() - self.last_used > SMTP_POOL_MAX_IDLE)
+
+    def open(self):
+        """Open and authenticate a fresh connection to the configured server"""
+        cfg = smtp_config()
+        self.address = (cfg.server, cfg.port)
+        server = ResumingSMTP_SSL(
+            cfg.server, cfg.port, context=_SSL_CONTEXT,
+            session=_tls_sessions.get(self.address))
+        server.login(user=cfg.sender_address, password=cfg.password)
+        self.server = server
+        return server
+
+    def connection(self):
+        """Return live server connection, (re)opening as needed"""
+        if self.server is not None:
+            try:
+                status, _ = self.server.noop()
+                if status == 250:
+                    return self.server
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.close()
+        return self.open()
+
+    def close(self):
+        """Close connection if open; safe to call repeatedly"""
+        if self.server is None:
+            return
+        # retain session for resumption by the next connection; with TLS 1.3
+        # the session ticket only arrives after the handshake, so look now
+        session = getattr(self.server.sock, 'session', None)
+        if session is not None:
+            _tls_sessions[self.address] = session
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            # already gone, nothing more to clean up
+            pass
+        finally:
+            self.server = None
+            self.messages_sent = 0
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send message on live connection
+
+        Not retried if dropped mid-send, as the server may already have
+        accepted the message; the caller's error handling applies instead.
+        """
+        try:
+            result = self.connection().sendmail(from_addr=from_addr, to_addrs=to_addrs, msg=msg)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            raise
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        return result
+
+
+# idle connections, keyed by (server, port, sender), shared by all
+# `send_email` calls not given an explicit connection
+_smtp_pool: dict[tuple, queue.LifoQueue] = {}
+_smtp_pool_lock = threading.Lock()
+
+
+@contextmanager
+def pooled_smtp_connection():
+    """Borrow an SMTPConnection from the module level pool
+
+    Connections are returned to the pool on success for reuse by later
+    sends, or closed on error, or once `SMTPConnection.expired()`.
+    """
+    cfg = smtp_config()
+    key = (cfg.server, cfg.port, cfg.sender_address)
+    with _smtp_pool_lock:
+        pool = _smtp_pool.setdefault(key, queue.LifoQueue())
+    try:
+        connection = pool.get_nowait()
+    except queue.Empty:
+        connection = SMTPConnection()
+    if connection.expired():
+        connection.close()
+
+    try:
+        yield connection
+    except Exception:
+        connection.close()
+        raise
+    if connection.expired():
+        connection.close()
+    else:
+        pool.put(connection)
+
+
+@atexit.register
+def drain_smtp_pool():
+    """Close all idle pooled connections"""
+    with _smtp_pool_lock:
+        pools = list(_smtp_pool.values())
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+@contextmanager
+def smtp_session():
+    """Context managed SMTPConnection, closed on exit
+
+    Use to share a single connection over a batch of `send_email` calls::
+
+        with smtp_session() as connection:
+            for ...:
+                send_email(..., connection=connection)
+
+    NB the connection isn't opened until first used, so no connection is
+    made if nothing ends up being sent.
+    """
+    connection = SMTPConnection()
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+def send_email(recipient_emails: list, subject, text, html, connection=None, undisclosed_recipients=False):
+    """Utility function to send given email
+
+    :param connection: optional SMTPConnection to reuse, see `smtp_session()`.
+      when undefined, a connection is borrowed from the module level pool,
+      see `pooled_smtp_connection()`
+    :param undisclosed_recipients: set true to keep recipients out of the
+      ``To`` header, such as when sending the same email to unrelated people
+    """
+    cfg = smtp_config()
+    sender_name = cfg.sender_name
 
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
     msg['From'] = sender_name
-    msg.add_header("To", ' '.join(recipient_emails))
-    msg.add_header("List-Unsubscribe", f"{current_app.config.get('ISACC_APP_URL')}/unsubscribe")
+    if undisclosed_recipients:
+        msg.add_header("To", "undisclosed-recipients:;")
+    else:
+        msg.add_header("To", ', '.join(recipient_emails))
+    msg.add_header("List-Unsubscribe", cfg.unsubscribe_url)
     msg.add_header("Date", utils.format_datetime(utils.localtime()))
     msg.add_header("Message-Id", utils.make_msgid())
 
@@ -32,24 +248,53 @@ def send_email(recipient_emails: list, subject, text, html):
     part2 = MIMEText(html, 'html')
     msg.attach(part2)
 
-    # Create a secure SSL context
-    context = ssl.create_default_context()
-
-    if current_app.config.get('MAIL_SUPPRESS_SEND'):
+    if cfg.suppress_send:
         return
 
+    if connection is None:
+        with pooled_smtp_connection() as connection:
+            _sendmail(connection, sender_name, recipient_emails, msg)
+    else:
+        _sendmail(connection, sender_name, recipient_emails, msg)
+
+
+def send_emails_batch(messages):
+    """Send several emails over a single SMTP connection
+
+    :param messages: iterable of dicts, each holding `send_email()` keyword
+      arguments (excluding `connection`)
+
+    Sending continues past failures, which `send_email()` audits; the first
+    failure is raised once all messages have been attempted.
+    """
+    first_error = None
+    with smtp_session() as connection:
+        for message in messages:
+            try:
+                send_email(connection=connection, **message)
+            except Exception as e:
+                first_error = first_error or e
+    if first_error:
+        raise first_error
+
+
+def _sendmail(connection, sender_name, recipient_emails, msg):
+    """Send assembled message on given connection, auditing the outcome"""
     try:
-        with smtplib.SMTP_SSL(email_server, port, context=context) as server:
-            server.login(user=sender_email, password=app_password)
-            server.sendmail(from_addr=sender_name, to_addrs=recipient_emails, msg=msg.as_string())
-            audit_entry(
-                f"Email notification sent",
-                extra={
-                    'email_message': msg.as_string(),
-                    'recipients': recipient_emails
-                },
-                level='info'
-            )
+        body = msg.as_bytes(policy=_SMTP_POLICY)
+        connection.sendmail(from_addr=sender_name, to_addrs=recipient_emails, msg=body)
+        # identify the message without writing its full content to the log
+        audit_entry(
+            f"Email notification sent",
+            extra={
+                'subject': msg['Subject'],
+                'message_id': msg['Message-Id'],
+                'body_sha256': hashlib.sha256(body).hexdigest(),
+                'body_len': len(body),
+                'recipients': recipient_emails
+            },
+            level='info'
+        )
     except Exception as e:
         audit_entry(
             f"Email notification could not be sent",
@@ -1,9 +1,34 @@
+from collections import defaultdict
 from flask import current_app
+from functools import lru_cache
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
 from urllib.parse import parse_qs, urlsplit
+from urllib3.util.retry import Retry
 
 from isacc_messaging.audit import audit_entry
 
+# Shared by all HAPI requests, keeping connections to the FHIR store alive
+# between calls.  Only idempotent methods are retried, on gateway errors.
+_HAPI_SESSION = requests.Session()
+_HAPI_ADAPTER = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False))
+_HAPI_SESSION.mount("http://", _HAPI_ADAPTER)
+_HAPI_SESSION.mount("https://", _HAPI_ADAPTER)
+# By default, HAPI caches search results for 60000 milliseconds,
+# meaning new patients won't immediately appear in results.
+# Disable caching until we find the need and safe use cases
+_HAPI_SESSION.headers.update({"Cache-Control": "no-cache"})
+
 
 class IsaccFhirException(Exception):
     """Raised when a FHIR resource or attribute required for ISACC to operate correctly is missing"""
@@ -15,41 +40,152 @@ class IsaccNotFoundError(Exception):
     pass
 
 
-def resolve_reference(reference_string):
-    """FHIRClient includes a `resolved()` method, but has yet to implement
+class IsaccVersionConflict(ValueError):
+    """Raised when a write conditional on version (If-Match) finds the resource since changed"""
+    pass
 
-    :param reference_string: i.e. "Patient/2"
-    :return: instantiated FHIRClient instance by fetching resource
+
+class TTLCache:
+    """Thread safe cache of FHIR JSON, each value expiring `ttl` seconds after set
+
+    Used to spare repeat reads of the same resource within a short window,
+    such as several messages to or from a single patient.  Writes made by
+    `HAPI_request` evict the written resource; changes made by other FHIR
+    store clients are seen once the cached value expires.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value for key, or None if missing or expired"""
+        with self._lock:
+            hit = self._data.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+
+    def set(self, key, value, ttl):
+        """Cache value for ttl seconds; no-op unless ttl is positive"""
+        if not ttl or ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data = {k: v for k, v in self._data.items() if v[0] > now}
+                if len(self._data) >= self.maxsize:
+                    self._data.clear()
+            self._data[key] = (now + ttl, value)
+
+    def pop(self, key):
+        """Evict key, if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# FHIR resources recently read, keyed by reference, i.e. "Patient/2"
+resource_cache = TTLCache()
+
+
+def fhir_cache_ttl():
+    """Seconds to retain cached FHIR reads; 0 disables caching"""
+    return current_app.config.get("FHIR_CACHE_TTL", 0)
+
+
+@lru_cache(maxsize=1)
+def _supported_classes():
+    """Classes `resolve_reference()` instantiates, keyed by resource type
+
+    Imported on first use, to avoid a circular import
     """
     from fhirclient.models.careteam import CareTeam
     from fhirclient.models.practitioner import Practitioner
     from isacc_messaging.models.isacc_patient import IsaccPatient as Patient
 
     # expand supported class list as needed
-    supported_classes = {
+    return {
         "CareTeam": CareTeam,
         "Patient": Patient,
         "Practitioner": Practitioner,
     }
+
+
+def resolve_reference(reference_string, fresh=False):
+    """FHIRClient includes a `resolved()` method, but has yet to implement
+
+    :param reference_string: i.e. "Patient/2"
+    :param fresh: set true to bypass `resource_cache`, as when deciding what
+      to write; other processes' writes don't evict this process' cache
+    :return: instantiated FHIRClient instance by fetching resource
+
+    Fetched resources are briefly cached, see `resource_cache`
+    """
     resource_type, id = reference_string.split('/')
-    klass = supported_classes.get(resource_type)
+    klass = _supported_classes().get(resource_type)
     if klass is None:
         raise ValueError("resource_type: {resource_type} not in supported")
 
-    result = HAPI_request('GET', resource_type, resource_id=id)
+    result = None if fresh else resource_cache.get(reference_string)
+    if result is None:
+        result = HAPI_request('GET', resource_type, resource_id=id)
+        if result is not None:
+            resource_cache.set(reference_string, result, fhir_cache_ttl())
     if result is not None:
         return klass(result)
     raise IsaccNotFoundError("{reference_string} NOT FOUND")
 
 
+def prefetch_references(references, include=None, batch_size=100):
+    """Bulk read referenced resources into `resource_cache`
+
+    Spares the individual reads `resolve_reference()` would otherwise make
+    for each, when many are about to be resolved.  Does nothing when
+    caching is disabled.
+
+    :param references: iterable of references, i.e. ["Patient/1", "Patient/2"]
+    :param include: optional ``_include`` search parameter, such as
+      "Patient:general-practitioner", to also cache resources referenced
+    :param batch_size: maximum ids per search, bounding request length
+    """
+    ttl = fhir_cache_ttl()
+    if ttl <= 0:
+        return
+
+    ids_by_type = defaultdict(set)
+    for reference in references:
+        if resource_cache.get(reference) is None:
+            resource_type, id = reference.split('/')
+            ids_by_type[resource_type].add(id)
+
+    for resource_type, ids in ids_by_type.items():
+        ids = sorted(ids)
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            params = {"_id": ",".join(batch), "_count": len(batch)}
+            if include:
+                params["_include"] = include
+            bundle = HAPI_request('GET', resource_type, params=params)
+            for resource in next_in_bundle(bundle):
+                resource_cache.set(
+                    f"{resource['resourceType']}/{resource['id']}", resource, ttl)
+
+
 def first_in_bundle(bundle):
     """Return first resource in bundle
 
     :param bundle:  Fresh JSON bundle from FHIR store
     :return: first resource found in bundle
+
+    NB HAPI may omit ``total`` from paged results, such as those limited
+    by ``_count``; the entry list is checked instead
     """
     if bundle['resourceType'] == 'Bundle':
-        if bundle['total'] > 0:
+        if bundle.get('entry'):
             return bundle['entry'][0]['resource']
 
 
@@ -61,45 +197,114 @@ def next_in_bundle(bundle):
     Yields each respective resource from the bundle's entry list
     until exhousted.
     """
-    def next_in_page(result):
-        if result['resourceType'] == 'Bundle' and result['total'] > 0:
-            for entry in result['entry']:
+    result = bundle
+    while True:
+        # pages beyond the first may be empty (i.e. entries filtered out
+        # by the server) yet still link to more; don't stop short
+        if result['resourceType'] == 'Bundle':
+            for entry in result.get('entry', ()):
                 yield entry['resource']
 
-    def next_page(result):
-        while len([link['url'] for link in result["link"] if link['relation'] == 'next']) > 0:
-            next_page_url = [link['url'] for link in result["link"] if link['relation'] == 'next'][0]
-            next_page_url = urlsplit(next_page_url)
-            params = parse_qs(next_page_url.query)
-            result = HAPI_request('GET', params=params)
-            yield result
+        next_page_url = next(
+            (link['url'] for link in result.get('link', ()) if link['relation'] == 'next'),
+            None)
+        if not next_page_url:
+            return
+        params = parse_qs(urlsplit(next_page_url).query)
+        result = HAPI_request('GET', params=params)
 
-    # yield each resource from first page
-    for i in next_in_page(bundle):
-        yield i
 
-    # continue through remaining pages
-    for page in next_page(bundle):
-        # yield each resource from each subsequent page
-        for i in next_in_page(page):
-            yield i
+@lru_cache(maxsize=1)
+def _fhir_url(app):
+    """FHIR_URL config value, read once per app as needed on every request
+
+    :param app: Flask app, also serving as the cache key
+    """
+    return app.config.get("FHIR_URL")
 
-    return
+
+def _fhir_json(resource):
+    """Encode resource for request body; orjson encodes several times faster than json"""
+    if resource is not None:
+        return orjson.dumps(resource)
+
+
+def _json_headers(headers):
+    """Request headers including the JSON content type, as `_fhir_json()` bypasses requests"""
+    return {"Content-Type": "application/fhir+json", **(headers or {})}
 
 
 def HAPI_request(
-    method, resource_type=None, resource_id=None, resource=None, params=None
+    method, resource_type=None, resource_id=None, resource=None, params=None, headers=None
 ):
     """Execute HAPI request on configured system - return JSON
 
-    :param method: HTTP verb, POST, PUT, GET, DELETE
+    :param method: HTTP verb, POST, PUT, PATCH, GET, DELETE
     :param resource_type: String naming desired such as ``Patient``
     :param resource_id: Optional, used when requesting specific resource
-    :param resource: FHIR resource used in PUT/POST
+    :param resource: FHIR resource used in PUT/POST, or list of JSON Patch
+      operations for PATCH
     :param params: Optional additional search parameters
+    :param headers: Optional additional request headers
 
     """
-    url = current_app.config.get("FHIR_URL")
+    resp = _HAPI_response(method, resource_type, resource_id, resource, params, headers)
+    # orjson decodes large bundles several times faster than resp.json()
+    return orjson.loads(resp.content)
+
+
+def HAPI_conditional_create(resource_type, resource, condition):
+    """POST resource unless one matching condition already exists
+
+    Single round trip alternative to a search followed by a create, see
+    FHIR conditional create (``If-None-Exist``).
+
+    :param resource_type: String naming resource type such as ``Communication``
+    :param resource: FHIR resource JSON to create
+    :param condition: search query identifying a match, i.e.
+      "based-on=CommunicationRequest/1"
+    :return: tuple (created, resource JSON); created is false when the
+      returned resource is the pre-existing match
+    """
+    resp = _HAPI_response(
+        'POST', resource_type, resource=resource, headers={"If-None-Exist": condition})
+    return resp.status_code == 201, orjson.loads(resp.content)
+
+
+def HAPI_transaction(*entries):
+    """Write given resources in a single FHIR transaction
+
+    Spares a round trip per resource when several are written together,
+    all succeeding or failing as one.
+
+    :param entries: (method, resource JSON) pairs, method being POST or PUT
+    :return: list of resulting references, i.e. "Communication/12", in
+      order of entries
+    """
+    bundle = {"resourceType": "Bundle", "type": "transaction", "entry": []}
+    for method, resource in entries:
+        url = resource["resourceType"]
+        if method == "PUT":
+            url = f"{url}/{resource['id']}"
+            resource_cache.pop(url)
+        bundle["entry"].append(
+            {"resource": resource, "request": {"method": method, "url": url}})
+
+    response = HAPI_request('POST', resource=bundle)
+    # locations include version, i.e. "Communication/12/_history/1"
+    return [
+        "/".join(entry["response"]["location"].split("/")[:2])
+        for entry in response.get("entry", ())]
+
+
+def _HAPI_response(
+    method, resource_type=None, resource_id=None, resource=None, params=None, headers=None
+):
+    """Execute HAPI request on configured system - return successful response
+
+    See `HAPI_request()` for parameters
+    """
+    url = _fhir_url(current_app._get_current_object())
     if resource_type:
         url = url + resource_type
 
@@ -109,37 +314,47 @@ def HAPI_request(
         url = "/".join((url, str(resource_id)))
 
     VERB = method.upper()
+    if VERB in ("PUT", "PATCH", "DELETE") and resource_id is not None:
+        resource_cache.pop(f"{resource_type}/{resource_id}")
     if VERB == "GET":
-        # By default, HAPI caches search results for 60000 milliseconds,
-        # meaning new patients won't immediately appear in results.
-        # Disable caching until we find the need and safe use cases
-        headers = {"Cache-Control": "no-cache"}
         try:
-            resp = requests.get(
-                url, headers=headers, params=params, timeout=30
-            )
+            resp = _HAPI_SESSION.get(url, params=params, headers=headers, timeout=30)
         except requests.exceptions.ConnectionError as error:
             current_app.logger.exception(error)
             raise RuntimeError(f"{url} inaccessible")
     elif VERB == "POST":
-        resp = requests.post(
-            url, params=params, json=resource, timeout=30
+        resp = _HAPI_SESSION.post(
+            url, params=params, data=_fhir_json(resource), headers=_json_headers(headers),
+            timeout=30
         )
     elif VERB == "PUT":
-        resp = requests.put(
-            url, params=params, json=resource, timeout=30
+        resp = _HAPI_SESSION.put(
+            url, params=params, data=_fhir_json(resource), headers=_json_headers(headers),
+            timeout=30
+        )
+    elif VERB == "PATCH":
+        # Only enable patch of resource by id
+        if not resource_id:
+            raise ValueError("'resource_id' required for PATCH")
+        resp = _HAPI_SESSION.patch(
+            url, data=orjson.dumps(resource),
+            headers={"Content-Type": "application/json-patch+json", **(headers or {})},
+            timeout=30
         )
     elif VERB == "DELETE":
         # Only enable deletion of resource by id
         if not resource_id:
             raise ValueError("'resource_id' required for DELETE")
-        resp = requests.delete(url, timeout=30)
+        resp = _HAPI_SESSION.delete(url, headers=headers, timeout=30)
     else:
         raise ValueError(f"Invalid HTTP method: {method}")
 
     try:
         resp.raise_for_status()
     except requests.exceptions.HTTPError as err:
+        if headers and "If-Match" in headers and resp.status_code in (409, 412):
+            # left for the caller to reapply to the current version
+            raise IsaccVersionConflict(err)
         current_app.logger.exception(err)
         audit_entry(
             f"Failed HAPI call ({method} {resource_type} {resource_id} {resource} {params}): {err}",
@@ -148,5 +363,5 @@ def HAPI_request(
         )
         raise ValueError(err)
 
-    return resp.json()
+    return resp
 
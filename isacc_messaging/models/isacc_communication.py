@@ -5,7 +5,22 @@ the `fhirclient.Communication` class.
 """
 from fhirclient.models.communication import Communication
 
-from isacc_messaging.models.fhir import HAPI_request
+from isacc_messaging.models.fhir import HAPI_request, next_in_bundle
+
+COMMUNICATION_TYPE_SYSTEM = "https://isacc.app/CodeSystem/communication-type"
+
+
+def _category(code):
+    return [{"coding": [{"system": COMMUNICATION_TYPE_SYSTEM, "code": code}]}]
+
+
+# Invariant JSON shared by every Communication built; treat as read only
+CATEGORY_AUTO_SENT = _category("isacc-auto-sent-message")
+CATEGORY_MANUALLY_SENT = _category("isacc-manually-sent-message")
+CATEGORY_RECEIVED = _category("isacc-received-message")
+MEDIUM_SMSWRIT = [{"coding": [{
+    "system": "http://terminology.hl7.org/ValueSet/v3-ParticipationMode",
+    "code": "SMSWRIT"}]}]
 
 
 class IsaccCommunication(Communication):
@@ -18,11 +33,10 @@ class IsaccCommunication(Communication):
 
     def is_manual_follow_up_message(self) -> bool:
         """returns true IFF the communication category shows manually sent"""
-        for category in self.category:
-            for coding in category.coding:
-                if coding.system == 'https://isacc.app/CodeSystem/communication-type':
-                    if coding.code == 'isacc-manually-sent-message':
-                        return True
+        return any(
+            coding.system == COMMUNICATION_TYPE_SYSTEM and coding.code == 'isacc-manually-sent-message'
+            for category in (self.category or ())
+            for coding in (category.coding or ()))
 
     def persist(self):
         """Persist self state to FHIR store"""
@@ -69,3 +83,18 @@ class IsaccCommunication(Communication):
             "sender": f"Patient/{patient.id}",
             "_sort": "-sent",
         })
+
+    @staticmethod
+    def oldest_from_patient(patient, since=None):
+        """Return oldest Communication received from patient, or None
+
+        :param since: optional FHIRDate; only consider those sent at or after
+        """
+        params = {
+            "sender": f"Patient/{patient.id}",
+            "_sort": "sent",
+            "_count": 1,
+        }
+        if since is not None:
+            params["sent"] = f"ge{since.isostring}"
+        return next(next_in_bundle(HAPI_request('GET', 'Communication', params=params)), None)
@@ -3,12 +3,23 @@
 Captures common methods needed by ISACC for CommunicationRequests, by specializing
 the `fhirclient.CommunicationRequest` class.
 """
-from datetime import datetime
 from fhirclient.models.communicationrequest import CommunicationRequest
 from fhirclient.models.identifier import Identifier
 from isacc_messaging.audit import audit_entry
 
 from isacc_messaging.models.fhir import HAPI_request, first_in_bundle
+from isacc_messaging.models.isacc_communication import (
+    CATEGORY_AUTO_SENT,
+    CATEGORY_MANUALLY_SENT,
+    MEDIUM_SMSWRIT,
+)
+from isacc_messaging.models.isacc_fhirdate import IsaccFHIRDate, local_now_iso
+
+TWILIO_SID_SYSTEM = "http://isacc.app/twilio-message-sid"
+TWILIO_STATUS_URL = "http://isacc.app/twilio-message-status"
+TWILIO_STATUS_UPDATED_URL = "http://isacc.app/twilio-message-status-updated"
+# search value matching outgoing message categories, scheduled or manual
+OUTGOING_CATEGORIES = "isacc-scheduled-message,isacc-manually-sent-message"
 
 
 class IsaccCommunicationRequest(CommunicationRequest):
@@ -23,7 +34,7 @@ class IsaccCommunicationRequest(CommunicationRequest):
     def next_by_patient(patient):
         """Lookup next active CommunicationRequest for given patient"""
         response = HAPI_request('GET', 'CommunicationRequest', params={
-            "category": "isacc-scheduled-message,isacc-manually-sent-message",
+            "category": OUTGOING_CATEGORIES,
             "status": "active",
             "recipient": f"Patient/{patient.id}",
             "_sort": "occurrence",
@@ -33,74 +44,104 @@ class IsaccCommunicationRequest(CommunicationRequest):
         if first:
             return CommunicationRequest(first)
 
+    def twilio_identifier(self, sid=None):
+        """Return Twilio message identifier, matching sid if given, else None"""
+        return next((
+            i for i in (self.identifier or ())
+            if i.system == TWILIO_SID_SYSTEM and (sid is None or i.value == sid)), None)
+
+    def update_twilio_status(self, sid, status):
+        """Record status of Twilio message sid, and time updated, on its identifier
+
+        NB only updates self; see `persist()`, or apply the returned
+        operations with a PATCH
+        :return: JSON Patch operations making the same change, empty if
+          self has no identifier for sid
+        """
+        identifier = self.twilio_identifier(sid)
+        if identifier is None:
+            return []
+        path = f"/identifier/{self.identifier.index(identifier)}"
+        # guard against the identifier list changing since read
+        operations = [{"op": "test", "path": f"{path}/value", "value": sid}]
+        for n, e in enumerate(identifier.extension or ()):
+            if e.url == TWILIO_STATUS_URL:
+                e.valueCode = status
+                operations.append({
+                    "op": "replace", "path": f"{path}/extension/{n}/valueCode", "value": status})
+            elif e.url == TWILIO_STATUS_UPDATED_URL:
+                e.valueDateTime = IsaccFHIRDate(local_now_iso())
+                operations.append({
+                    "op": "replace", "path": f"{path}/extension/{n}/valueDateTime",
+                    "value": e.valueDateTime.isostring})
+        return operations
+
     def dispatched(self):
-        return self.identifier and len([i for i in self.identifier if i.system == "http://isacc.app/twilio-message-sid"]) > 0
+        return self.twilio_identifier() is not None
 
     def dispatched_message_status(self):
             sid = ""
             status = ""
             as_of = ""
-            for i in self.identifier:
-                for e in i.extension:
-                    if e.url == "http://isacc.app/twilio-message-status":
+            identifier = self.twilio_identifier()
+            if identifier is not None:
+                sid = identifier.value
+                for e in identifier.extension or ():
+                    if e.url == TWILIO_STATUS_URL:
                         status = e.valueCode
-                    if e.url == "http://isacc.app/twilio-message-status-updated":
+                    elif e.url == TWILIO_STATUS_UPDATED_URL:
                         as_of = e.valueDateTime.isostring
-                if i.system == "http://isacc.app/twilio-message-sid":
-                    sid = i.value
             return f"Twilio message (sid: {sid}, CR.id: {self.id}) was previously dispatched. Last known status: {status} (as of {as_of})"
 
     def mark_dispatched(self, expanded_payload, result):
             self.payload[0].contentString = expanded_payload
+            operations = [
+                {"op": "replace", "path": "/payload/0/contentString", "value": expanded_payload}]
             if not self.identifier:
                 self.identifier = []
-            self.identifier.append(Identifier({
-                "system": "http://isacc.app/twilio-message-sid",
+                operations.append({"op": "add", "path": "/identifier", "value": []})
+            identifier = Identifier({
+                "system": TWILIO_SID_SYSTEM,
                 "value": result.sid,
                 "extension": [
                     {
-                        "url": "http://isacc.app/twilio-message-status",
+                        "url": TWILIO_STATUS_URL,
                         "valueCode": result.status
                     },
                     {
-                        "url": "http://isacc.app/twilio-message-status-updated",
-                        "valueDateTime": datetime.now().astimezone().isoformat()
+                        "url": TWILIO_STATUS_UPDATED_URL,
+                        "valueDateTime": local_now_iso()
                     },
                 ]
-            }))
-            updated_cr = HAPI_request('PUT', 'CommunicationRequest', resource_id=self.id, resource=self.as_json())
+            })
+            self.identifier.append(identifier)
+            # patch only the change, rather than PUT the whole request
+            operations.append({"op": "add", "path": "/identifier/-", "value": identifier.as_json()})
+            updated_cr = HAPI_request(
+                'PATCH', 'CommunicationRequest', resource_id=self.id, resource=operations)
             return updated_cr
 
     def create_communication_from_request(self, status = "completed"):
         if self.category[0].coding[0].code == 'isacc-manually-sent-message':
-            code = 'isacc-manually-sent-message'
+            category = CATEGORY_MANUALLY_SENT
         else:
-            code = "isacc-auto-sent-message"
-        return {
+            category = CATEGORY_AUTO_SENT
+        communication = {
             "resourceType": "Communication",
             "id": str(self.id),
             "basedOn": [{"reference": f"CommunicationRequest/{self.id}"}],
             "partOf": [{"reference": f"{self.basedOn[0].reference}"}],
-            "category": [{
-                "coding": [{
-                    "system": "https://isacc.app/CodeSystem/communication-type",
-                    "code": code
-                }]
-            }],
-
+            "category": category,
             "payload": [p.as_json() for p in self.payload],
-            "sent": datetime.now().astimezone().isoformat(),
+            "sent": local_now_iso(),
             "sender": self.sender.as_json() if self.sender else None,
             "recipient": [r.as_json() for r in self.recipient],
-            "medium": [{
-                "coding": [{
-                    "system": "http://terminology.hl7.org/ValueSet/v3-ParticipationMode",
-                    "code": "SMSWRIT"
-                }]
-            }],
+            "medium": MEDIUM_SMSWRIT,
             "note": [n.as_json() for n in self.note] if self.note else None,
             "status": status
         }
+        # omit absent elements, as `as_json()` would
+        return {k: v for k, v in communication.items() if v is not None}
 
     def persist(self):
         """Persist self state to FHIR store"""
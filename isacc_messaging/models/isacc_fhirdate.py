@@ -3,8 +3,25 @@
 Captures common methods needed by ISACC for FHIRDate, by specializing
 the `fhirclient.FHIRDate` class.
 """
+from datetime import datetime
 from fhirclient.models.fhirdate import FHIRDate
 
+# Local timezone, resolved once at import rather than by every
+# `datetime.now().astimezone()`.  NB this is a fixed offset, so after a
+# daylight saving change times remain correct instants, expressed in the
+# prior offset until restart
+LOCAL_TZ = datetime.now().astimezone().tzinfo
+
+
+def local_now() -> datetime:
+    """Current time, timezone aware, see `LOCAL_TZ`"""
+    return datetime.now(LOCAL_TZ)
+
+
+def local_now_iso() -> str:
+    """Current time, as ISO 8601 string with offset, see `LOCAL_TZ`"""
+    return datetime.now(LOCAL_TZ).isoformat()
+
 
 class IsaccFHIRDate(FHIRDate):
 
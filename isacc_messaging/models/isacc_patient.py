@@ -3,10 +3,13 @@
 Captures common methods needed by ISACC for Patients, by specializing the `fhirclient.Patient` class.
 """
 from fhirclient.models.extension import Extension
+from fhirclient.models.fhirdate import FHIRDate as BaseFHIRDate
 from fhirclient.models.patient import Patient
+from fhirclient.models.period import Period
 import logging
 from datetime import datetime
 from fhirclient.models.careplan import CarePlan
+from flask import current_app
 
 from isacc_messaging.audit import audit_entry
 from isacc_messaging.models.isacc_communication import IsaccCommunication as Communication
@@ -17,10 +20,14 @@ from isacc_messaging.models.isacc_fhirdate import (
 )
 from isacc_messaging.models.fhir import (
     HAPI_request,
+    fhir_cache_ttl,
     first_in_bundle,
     next_in_bundle,
+    prefetch_references,
     resolve_reference,
+    resource_cache,
     IsaccFhirException,
+    IsaccVersionConflict,
 )
 
 # URLs for patient extensions
@@ -37,24 +44,29 @@ class IsaccPatient(Patient):
         return f"{self.resource_type}/{self.id}"
 
     @staticmethod
-    def active_patients():
+    def active_patients(count=500):
         """Execute query for active patients
 
         NB, returns only patients with active set to true
+
+        :param count: page size; generous to limit round trips when paging
         """
         response = HAPI_request('GET', 'Patient', params={
-            "active": "true"
+            "active": "true",
+            "_count": count,
         })
         return response
 
     @staticmethod
-    def all_patients():
+    def all_patients(count=500):
         """Execute query for all patients
 
         NB, until status is set on all patients, queries for
         any status/active value will skip those without a value.
+
+        :param count: page size; generous to limit round trips when paging
         """
-        response = HAPI_request('GET', 'Patient')
+        response = HAPI_request('GET', 'Patient', params={"_count": count})
         return response
 
     @staticmethod
@@ -72,16 +84,40 @@ class IsaccPatient(Patient):
                     return t.value
         raise IsaccFhirException(f"Error: {self} doesn't have an sms contact point on file")
 
+    def get_careplan_id(self):
+        """Lookup id of patient's active CarePlan, cached longer than `get_careplan()`
+
+        Only the id is retained, for up to ``CAREPLAN_ID_CACHE_TTL`` seconds,
+        as a patient's active CarePlan is rarely replaced.
+        """
+        cache_key = f"CarePlan.id?subject=Patient/{self.id}"
+        careplan_id = resource_cache.get(cache_key)
+        if careplan_id is None:
+            care_plan = self.get_careplan()
+            if care_plan is None:
+                return
+            careplan_id = care_plan.id
+            resource_cache.set(
+                cache_key, careplan_id, current_app.config.get("CAREPLAN_ID_CACHE_TTL", 0))
+        return careplan_id
+
     def get_careplan(self) -> CarePlan:
-        result = HAPI_request(
-            'GET', 'CarePlan',
-            params={
-                "subject": f"Patient/{self.id}",
-                "category": "isacc-message-plan",
-                "status": "active",
-                "_sort": "-_lastUpdated"})
-
-        result = first_in_bundle(result)
+        """Lookup patient's active CarePlan; briefly cached, see `resource_cache`"""
+        cache_key = f"CarePlan?subject=Patient/{self.id}"
+        result = resource_cache.get(cache_key)
+        if result is None:
+            result = HAPI_request(
+                'GET', 'CarePlan',
+                params={
+                    "subject": f"Patient/{self.id}",
+                    "category": "isacc-message-plan",
+                    "status": "active",
+                    "_sort": "-_lastUpdated",
+                    "_count": 1})
+            result = first_in_bundle(result)
+            if result is not None:
+                resource_cache.set(cache_key, result, fhir_cache_ttl())
+
         if result is not None:
             return CarePlan(result)
 
@@ -98,7 +134,10 @@ class IsaccPatient(Patient):
             # get the referenced CareTeam resource from the care plan
             # please see https://www.pivotaltracker.com/story/show/185407795
             # carePlan.careTeam now includes those that follow the patient
-            care_team = resolve_reference(care_plan.careTeam[0].reference)
+            care_team_ref = care_plan.careTeam[0].reference
+            # read the care team along with its participants in one request
+            prefetch_references([care_team_ref], include="CareTeam:participant")
+            care_team = resolve_reference(care_team_ref)
             if care_team and care_team.participant:
                 # format of participants: [{member: {reference: Practitioner/1}}]
                 for participant in care_team.participant:
@@ -117,15 +156,36 @@ class IsaccPatient(Patient):
             )
         return list(emails)
 
+    @property
+    def is_unsubscribed(self):
+        """True if patient's sms contact point has ended, see `unsubscribe()`"""
+        return any(
+            t.system and t.system.lower() == 'sms' and t.period is not None and t.period.end
+            for t in (self.telecom or ()))
+
+    def _sms_telecom(self):
+        return next((entry for entry in self.telecom if entry.system.lower() == 'sms'))
+
     def subscribe(self):
-        sms_telecom_entry = next((entry for entry in self.telecom if entry.system.lower() == 'sms'))
-        sms_telecom_entry.period.end = None
-        self.persist()
-    
+        def clear_end(patient):
+            sms_telecom_entry = patient._sms_telecom()
+            if sms_telecom_entry.period:
+                sms_telecom_entry.period.end = None
+
+        # conditional, as callers may hold a stale copy, see `persist_change()`
+        self.persist_change(clear_end)
+
     def unsubscribe(self):
-        sms_telecom_entry = next((entry for entry in self.telecom if entry.system.lower() == 'sms'))
-        sms_telecom_entry.period.end = FHIRDate(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
-        self.persist()
+        end = FHIRDate(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+        def set_end(patient):
+            sms_telecom_entry = patient._sms_telecom()
+            if sms_telecom_entry.period is None:
+                sms_telecom_entry.period = Period()
+            sms_telecom_entry.period.end = end
+
+        # conditional, as callers may hold a stale copy, see `persist_change()`
+        self.persist_change(set_end)
 
     def get_extension(self, url, attribute):
         """Get current value for extension of given url, or None if not found
@@ -138,7 +198,6 @@ class IsaccPatient(Patient):
         for most resources.  This method will return the current value to an extension on the
         Patient resource, with the matching url, or None if not found.
         """
-        from fhirclient.models.fhirdate import FHIRDate as BaseFHIRDate
         retval = None
         if not self.extension:
             return
@@ -207,7 +266,8 @@ class IsaccPatient(Patient):
             logging.debug(f"set Patient({self.id}) extension {NEXT_OUTGOING_URL}: {save_value} (was {existing})")
             self.set_extension(url=NEXT_OUTGOING_URL, value=save_value.isostring, attribute="valueDateTime")
             if persist_on_change:
-                result = self.persist()
+                result = self.persist_extension(
+                    url=NEXT_OUTGOING_URL, value=save_value.isostring, attribute="valueDateTime")
                 audit_entry(
                     f"Updated Patient({self.id}) next-outgoing extension to {save_value}",
                     extra={"resource": result},
@@ -244,13 +304,12 @@ class IsaccPatient(Patient):
                 most_recent_followup = max(most_recent_followup, FHIRDate(c["sent"]))
                 break
 
+        # the store finds the oldest reply not predating the latest followup,
+        # rather than paging through and parsing every reply
         oldest_reply = None
-        for c in next_in_bundle(Communication.from_patient(self)):
-            potential = FHIRDate(c["sent"])
-            # if the message predates the latest followup, we're done looking
-            if most_recent_followup and most_recent_followup > potential:
-                break
-            oldest_reply = potential
+        c = Communication.oldest_from_patient(self, since=most_recent_followup)
+        if c is not None:
+            oldest_reply = FHIRDate(c["sent"])
 
         save_value = oldest_reply
         if not oldest_reply:
@@ -263,7 +322,8 @@ class IsaccPatient(Patient):
             logging.debug(f"set Patient({self.id}) extension {LAST_UNFOLLOWEDUP_URL}: {save_value} (was {existing})")
             self.set_extension(url=LAST_UNFOLLOWEDUP_URL, value=save_value.isostring, attribute="valueDateTime")
             if persist_on_change:
-                result = self.persist()
+                result = self.persist_extension(
+                    url=LAST_UNFOLLOWEDUP_URL, value=save_value.isostring, attribute="valueDateTime")
                 audit_entry(
                     f"Updated Patient({self.id}) last-unfollowed-up extension to {save_value}",
                     extra={"resource": result},
@@ -280,11 +340,49 @@ class IsaccPatient(Patient):
         if vals and "HTEST" in vals:
             return True
 
-    def persist(self):
-        """Persist self state to FHIR store"""
+    def persist(self, if_match=False):
+        """Persist self state to FHIR store
+
+        NB by default an unconditional PUT, writing over any change made
+        since self was read; see `persist_change()` to avoid as much.
+
+        :param if_match: set true to only write over the version read;
+          raises `IsaccVersionConflict` if since changed
+        """
+        headers = None
+        if if_match and self.meta and self.meta.versionId:
+            headers = {"If-Match": f'W/"{self.meta.versionId}"'}
         response = HAPI_request(
             method="PUT",
             resource_type=self.resource_type,
             resource_id=self.id,
-            resource=self.as_json())
+            resource=self.as_json(),
+            headers=headers)
         return response
+
+    def persist_change(self, change):
+        """Apply change to self and persist, without losing concurrent writes
+
+        The write is conditional on the version read.  Should another
+        request have written the patient since (such as a concurrent
+        callback, or when read from `resource_cache`), the change is
+        applied to the current version and written once more.
+
+        :param change: callable taking the patient to modify; applied to
+          self, and again to the current version on conflict
+        """
+        change(self)
+        try:
+            return self.persist(if_match=True)
+        except IsaccVersionConflict:
+            current = IsaccPatient(HAPI_request('GET', 'Patient', resource_id=self.id))
+            change(current)
+            return current.persist(if_match=True)
+
+    def persist_extension(self, url, value, attribute):
+        """Set extension value and persist, without losing concurrent writes
+
+        See `set_extension()` for parameters, `persist_change()` for details
+        """
+        return self.persist_change(
+            lambda patient: patient.set_extension(url=url, value=value, attribute=attribute))
@@ -2,6 +2,7 @@
 
 Captures common methods needed by ISACC for Practitioners, by specializing the `fhirclient.Practitioner` class.
 """
+from collections import defaultdict
 from fhirclient.models.careteam import CareTeam
 from fhirclient.models.practitioner import Practitioner
 
@@ -22,13 +23,14 @@ class IsaccPractitioner(Practitioner):
         return f"{self.resource_type}/{self.id}"
 
     @staticmethod
-    def active_practitioners():
+    def active_practitioners(count=500):
         """Execute query for active practitioners
 
+        :param count: page size; generous to limit round trips when paging
         :returns: bundle of practitioners, in JSON format
         """
         # TODO consider active flag when set on all practitioners
-        response = HAPI_request('GET', 'Practitioner')
+        response = HAPI_request('GET', 'Practitioner', params={"_count": count})
         return response
 
     @property
@@ -45,21 +47,50 @@ class IsaccPractitioner(Practitioner):
                     return t.value
         raise IsaccFhirException(f"Error: {self} doesn't have an sms contact point on file")
 
-    def practitioner_patients(self, include_test_patients=False):
-        """Return bundle of patients for which this practitioner is a primary or secondary
+    @staticmethod
+    def patients_by_practitioner(include_test_patients=False, count=500):
+        """Return patients for every practitioner, keyed by practitioner id
+
+        A single (paged) CareTeam search, including each
+        CareTeam's subject Patient, in place of a search per practitioner
+        and a fetch per patient.
 
-        :returns: list of Patient objects
+        :param include_test_patients: set true to include test patients
+        :param count: page size; generous to limit round trips when paging
+        :returns: dict of practitioner id to list of Patient objects
         """
-        careteams = HAPI_request("GET", "CareTeam", params={"participant": f"Practitioner/{self.id}"})
-        patients = []
-        for ct in next_in_bundle(careteams):
+        from isacc_messaging.models.isacc_patient import IsaccPatient as Patient
+
+        careteams = HAPI_request("GET", "CareTeam", params={
+            "_include": "CareTeam:subject",
+            "_count": count,
+        })
+        patients = {}
+        teams = []
+        for resource in next_in_bundle(careteams):
+            if resource["resourceType"] == "Patient":
+                patients[f"Patient/{resource['id']}"] = Patient(resource)
+            elif resource["resourceType"] == "CareTeam":
+                teams.append(CareTeam(resource))
+
+        by_practitioner = defaultdict(list)
+        for careteam in teams:
             # Each care team has one patient at subject/reference
-            careteam = CareTeam(ct)
-            patient = resolve_reference(careteam.subject.reference)
+            patient_ref = careteam.subject.reference
+            patient = patients.get(patient_ref)
+            if patient is None:
+                # not included in search results; fetch directly
+                patient = patients[patient_ref] = resolve_reference(patient_ref)
             if not include_test_patients and patient.is_test_patient():
                 continue
-            patients.append(patient)
-        return patients
+            for participant in careteam.participant or ():
+                # member is optional, i.e. a participant known only by role
+                if not (participant.member and participant.member.reference):
+                    continue
+                member_ref = participant.member.reference
+                if member_ref.startswith("Practitioner/"):
+                    by_practitioner[member_ref.split("/", 1)[1]].append(patient)
+        return by_practitioner
 
     def persist(self):
         """Persist self state to FHIR store"""
@@ -1,3 +1,8 @@
+import logging
+
+from isacc_messaging.logserverhandler import BufferedLogServerHandler, _open_handlers
+
+
 def test_auditlog_missing_data(client):
     response = client.post('/auditlog')
     # no data, expect 400
@@ -31,3 +36,16 @@ def test_auditlog_post(client):
     }
     response = client.post('/auditlog', json=data)
     assert response.status_code == 200
+
+
+def test_buffered_handler_close(mocker):
+    target = mocker.Mock()
+    handler = BufferedLogServerHandler(target=target, capacity=10, flush_interval=60)
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "buffered", None, None)
+    handler.handle(record)
+
+    handler.close()
+    # background thread stopped, buffered record flushed and handler released
+    assert not handler._flusher.is_alive()
+    target.emit_batch.assert_called_once_with([record])
+    assert handler not in _open_handlers
@@ -0,0 +1,173 @@
+import smtplib
+from types import SimpleNamespace
+
+import pytest
+
+from isacc_messaging.api.email_notifications import (
+    MAX_RECIPIENTS_PER_EMAIL,
+    _dispatch_practitioner_emails,
+)
+from isacc_messaging.models.email import drain_smtp_pool, send_email, send_emails_batch, smtp_session
+from isacc_messaging.models.isacc_practitioner import IsaccPractitioner as Practitioner
+
+
+def test_smtp_session_reuses_connection(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+    server.noop.return_value = (250, b"OK")
+
+    with smtp_session() as connection:
+        for i in range(3):
+            send_email(
+                recipient_emails=[f"{i}@example.com"],
+                subject="subject",
+                text="text",
+                html="<p>html</p>",
+                connection=connection)
+
+    # single connection and login, used for all three emails
+    assert smtp.call_count == 1
+    assert server.login.call_count == 1
+    assert server.sendmail.call_count == 3
+    server.quit.assert_called_once()
+
+
+def test_smtp_session_reconnects(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+    server.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+    with smtp_session() as connection:
+        send_email(["a@example.com"], "subject", "text", "html", connection=connection)
+        send_email(["b@example.com"], "subject", "text", "html", connection=connection)
+
+    # dropped connection detected via NOOP prior to second send
+    assert smtp.call_count == 2
+    assert server.sendmail.call_count == 2
+
+
+def test_smtp_send_not_retried_on_disconnect(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+    server.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        with smtp_session() as connection:
+            send_email(["a@example.com"], "subject", "text", "html", connection=connection)
+
+    # the server may have accepted the message before dropping; don't resend
+    assert server.sendmail.call_count == 1
+
+def test_smtp_session_unused(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    with smtp_session():
+        pass
+    smtp.assert_not_called()
+
+
+def test_pooled_connection_reused(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+    server.noop.return_value = (250, b"OK")
+    mocker.patch("isacc_messaging.models.email.SMTP_POOL_MAX_MESSAGES", 2)
+
+    for i in range(3):
+        send_email([f"{i}@example.com"], "subject", "text", "html")
+
+    # recycled after two messages, the third reopens
+    assert smtp.call_count == 2
+    assert server.sendmail.call_count == 3
+    assert server.quit.call_count == 1
+
+    drain_smtp_pool()
+    assert server.quit.call_count == 2
+
+
+def test_tls_session_resumed(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+
+    with smtp_session() as connection:
+        send_email(["a@example.com"], "subject", "text", "html", connection=connection)
+    with smtp_session() as connection:
+        send_email(["b@example.com"], "subject", "text", "html", connection=connection)
+
+    # second connection offered the session retained from the first
+    assert smtp.call_args.kwargs["session"] is server.sock.session
+
+
+def test_send_emails_batch(app_context, mocker):
+    smtp = mocker.patch("isacc_messaging.models.email.ResumingSMTP_SSL")
+    server = smtp.return_value
+    server.noop.return_value = (250, b"OK")
+    server.sendmail.side_effect = [smtplib.SMTPRecipientsRefused({}), {}, {}]
+
+    messages = [
+        dict(recipient_emails=[f"{i}@example.com"], subject="subject", text="text", html="html")
+        for i in range(3)]
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        send_emails_batch(messages)
+
+    # all attempted on one connection, despite the first failing
+    assert smtp.call_count == 1
+    assert server.sendmail.call_count == 3
+
+
+def _practitioner(id):
+    return {
+        "resourceType": "Practitioner",
+        "id": id,
+        "telecom": [{"system": "email", "value": f"{id}@example.com"}]}
+
+
+def _dispatch(mocker, practitioner_ids, assemble_func):
+    """Run practitioner email dispatch, returning the messages sent"""
+    patient = SimpleNamespace(id="69")
+    mocker.patch.object(
+        Practitioner, "patients_by_practitioner",
+        return_value={id: [patient] for id in practitioner_ids})
+    mocker.patch.object(Practitioner, "active_practitioners", return_value={
+        "resourceType": "Bundle",
+        "entry": [{"resource": _practitioner(id)} for id in practitioner_ids]})
+    send = mocker.patch("isacc_messaging.api.email_notifications.send_emails_batch")
+
+    _dispatch_practitioner_emails(
+        category="test",
+        filter_func=lambda patient: True,
+        assemble_func=assemble_func,
+        dry_run=False,
+        include_test_patients=False)
+    return [message for call in send.call_args_list for message in call.args[0]]
+
+
+def test_practitioner_emails_grouped_by_content(app_context, mocker):
+    def assemble(practitioner, patients, cfg=None):
+        text = "other" if practitioner.id == "3" else "same"
+        return {"subject": "subject", "text": text, "html": f"<p>{text}</p>"}
+
+    messages = _dispatch(mocker, ("1", "2", "3"), assemble)
+    assert len(messages) == 2
+    by_text = {message["text"]: message for message in messages}
+
+    # identical content shares one email, recipients undisclosed
+    shared = by_text["same"]
+    assert shared["recipient_emails"] == ["1@example.com", "2@example.com"]
+    assert shared["html"] == "<p>same</p>"
+    assert shared["undisclosed_recipients"]
+
+    single = by_text["other"]
+    assert single["recipient_emails"] == ["3@example.com"]
+    assert not single["undisclosed_recipients"]
+
+
+def test_practitioner_emails_split_at_max_recipients(app_context, mocker):
+    def assemble(practitioner, patients, cfg=None):
+        return {"subject": "subject", "text": "same", "html": "<p>same</p>"}
+
+    ids = [str(i) for i in range(MAX_RECIPIENTS_PER_EMAIL + 2)]
+    messages = _dispatch(mocker, ids, assemble)
+    assert sorted(len(message["recipient_emails"]) for message in messages) == [
+        2, MAX_RECIPIENTS_PER_EMAIL]
+    recipients = [r for message in messages for r in message["recipient_emails"]]
+    assert sorted(recipients) == sorted(f"{id}@example.com" for id in ids)
+    assert all(message["undisclosed_recipients"] for message in messages)
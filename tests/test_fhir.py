@@ -0,0 +1,74 @@
+from isacc_messaging.models.fhir import (
+    HAPI_transaction,
+    TTLCache,
+    first_in_bundle,
+    resolve_reference,
+    resource_cache,
+)
+
+
+def test_ttl_cache(mocker):
+    clock = mocker.patch("isacc_messaging.models.fhir.time.monotonic", return_value=100)
+    cache = TTLCache()
+    cache.set("Patient/1", {"id": "1"}, ttl=30)
+    cache.set("Patient/2", {"id": "2"}, ttl=0)
+    assert cache.get("Patient/1") == {"id": "1"}
+    assert cache.get("Patient/2") is None
+
+    clock.return_value = 131
+    assert cache.get("Patient/1") is None
+
+
+def test_ttl_cache_pop():
+    cache = TTLCache()
+    cache.set("Patient/1", {"id": "1"}, ttl=30)
+    cache.pop("Patient/1")
+    assert cache.get("Patient/1") is None
+
+
+def test_first_in_bundle():
+    assert first_in_bundle({"resourceType": "Bundle", "total": 0}) is None
+    # paged results may lack total
+    assert first_in_bundle({
+        "resourceType": "Bundle",
+        "entry": [{"resource": {"resourceType": "Patient", "id": "1"}}],
+    }) == {"resourceType": "Patient", "id": "1"}
+
+
+def test_HAPI_transaction(mocker):
+    request = mocker.patch("isacc_messaging.models.fhir.HAPI_request", return_value={
+        "resourceType": "Bundle",
+        "type": "transaction-response",
+        "entry": [
+            {"response": {"status": "201 Created", "location": "Communication/12/_history/1"}},
+            {"response": {"status": "200 OK", "location": "CommunicationRequest/3/_history/2"}},
+        ]})
+    resource_cache.set("CommunicationRequest/3", {"id": "3"}, ttl=30)
+
+    comm = {"resourceType": "Communication", "status": "in-progress"}
+    cr = {"resourceType": "CommunicationRequest", "id": "3", "status": "completed"}
+    assert HAPI_transaction(("POST", comm), ("PUT", cr)) == [
+        "Communication/12", "CommunicationRequest/3"]
+
+    bundle = request.call_args.kwargs["resource"]
+    assert bundle["type"] == "transaction"
+    assert [e["request"] for e in bundle["entry"]] == [
+        {"method": "POST", "url": "Communication"},
+        {"method": "PUT", "url": "CommunicationRequest/3"}]
+    assert resource_cache.get("CommunicationRequest/3") is None
+
+
+def test_resolve_reference_fresh(mocker):
+    mocker.patch("isacc_messaging.models.fhir._supported_classes", return_value={"Patient": dict})
+    mocker.patch("isacc_messaging.models.fhir.fhir_cache_ttl", return_value=30)
+    request = mocker.patch(
+        "isacc_messaging.models.fhir.HAPI_request", return_value={"id": "1", "active": False})
+    resource_cache.set("Patient/1", {"id": "1", "active": True}, ttl=30)
+
+    assert resolve_reference("Patient/1") == {"id": "1", "active": True}
+    request.assert_not_called()
+
+    # bypasses the cache, refreshing it
+    assert resolve_reference("Patient/1", fresh=True) == {"id": "1", "active": False}
+    request.assert_called_once_with('GET', 'Patient', resource_id='1')
+    assert resource_cache.get("Patient/1") == {"id": "1", "active": False}
@@ -0,0 +1,221 @@
+from collections import Counter
+from datetime import timedelta
+import threading
+import time
+
+import pytest
+
+from isacc_messaging.api.isacc_record_creator import IsaccRecordCreator
+from isacc_messaging.models.isacc_communicationrequest import TWILIO_SID_SYSTEM
+from isacc_messaging.models.isacc_fhirdate import local_now
+from isacc_messaging.models.isacc_patient import IsaccPatient as Patient
+
+MODULE = "isacc_messaging.api.isacc_record_creator"
+
+
+def due_bundle(cr_jsons):
+    return {
+        "resourceType": "Bundle",
+        "total": len(cr_jsons),
+        "entry": [{"resource": cr_json} for cr_json in cr_jsons]}
+
+
+def due_cr(id, patient_id):
+    """Minimal due CommunicationRequest, as execute_request is mocked"""
+    return {"id": str(id), "recipient": [{"reference": f"Patient/{patient_id}"}]}
+
+
+@pytest.fixture
+def dispatch(app_context, mocker):
+    """Run execute_requests() over given CRs, with execute_request() mocked
+
+    :return: (successes, errors, execute_request mock, resolve_reference mock)
+    """
+    def run(cr_jsons, execute_request):
+        mocker.patch(f"{MODULE}.HAPI_request", return_value=due_bundle(cr_jsons))
+        mocker.patch(f"{MODULE}.prefetch_references")
+        resolve = mocker.patch(f"{MODULE}.resolve_reference")
+        execute = mocker.patch.object(
+            IsaccRecordCreator, "execute_request", side_effect=execute_request)
+        successes, errors = IsaccRecordCreator().execute_requests()
+        return successes, errors, execute, resolve
+    return run
+
+
+def sent(cr_json, cutoff):
+    return True, {"id": cr_json["id"], "status": "sent"}, None
+
+
+def test_execute_requests_throttled(dispatch):
+    cr_jsons = [due_cr(i, i) for i in range(40)]
+    successes, errors, execute, _ = dispatch(cr_jsons, sent)
+
+    # throttle limit of 30, counting those in flight, lets one more through
+    assert execute.call_count == 31
+    assert len(successes) == 31
+    assert errors == []
+
+
+def test_execute_requests_serialized_per_patient(dispatch):
+    lock = threading.Lock()
+    in_flight = Counter()
+    overlaps = []
+
+    def slow_send(cr_json, cutoff):
+        patient_ref = cr_json["recipient"][0]["reference"]
+        with lock:
+            in_flight[patient_ref] += 1
+            overlaps.append(in_flight[patient_ref])
+        time.sleep(0.01)
+        with lock:
+            in_flight[patient_ref] -= 1
+        return sent(cr_json, cutoff)
+
+    cr_jsons = [due_cr(i, i % 2) for i in range(8)]
+    successes, errors, _, _ = dispatch(cr_jsons, slow_send)
+
+    assert len(successes) == 8
+    # never two requests for the same patient at once
+    assert max(overlaps) == 1
+
+
+def test_execute_requests_failure_reported(dispatch):
+    def send(cr_json, cutoff):
+        if cr_json["id"] == "2":
+            raise RuntimeError("boom")
+        return sent(cr_json, cutoff)
+
+    cr_jsons = [due_cr(i, i) for i in range(5)]
+    successes, errors, _, _ = dispatch(cr_jsons, send)
+
+    assert errors == [{"id": "2", "error": "boom"}]
+    # others still executed
+    assert sorted(s["id"] for s in successes) == ["0", "1", "3", "4"]
+
+
+def test_execute_requests_next_outgoing_once_per_patient(dispatch):
+    cr_jsons = [due_cr(i, patient_id) for i, patient_id in enumerate((1, 1, 1, 2, 2))]
+    _, _, _, resolve = dispatch(cr_jsons, sent)
+
+    assert sorted(call.args[0] for call in resolve.call_args_list) == [
+        "Patient/1", "Patient/2"]
+    assert all(call.kwargs == {"fresh": True} for call in resolve.call_args_list)
+    assert resolve.return_value.mark_next_outgoing.call_count == 2
+
+
+@pytest.fixture
+def patient_json():
+    return {
+        "resourceType": "Patient",
+        "id": "69",
+        "active": True,
+        "telecom": [{"system": "sms", "value": "3602815483"}]}
+
+
+def cr_json(occurrence, **kwargs):
+    return {
+        "resourceType": "CommunicationRequest",
+        "id": "7",
+        "status": "active",
+        "category": [{"coding": [{
+            "system": "https://isacc.app/CodeSystem/communication-type",
+            "code": "isacc-scheduled-message"}]}],
+        "basedOn": [{"reference": "CarePlan/3"}],
+        "payload": [{"contentString": "Hello"}],
+        "recipient": [{"reference": "Patient/69"}],
+        "occurrenceDateTime": occurrence.isoformat(),
+        **kwargs}
+
+
+@pytest.fixture
+def execute(app_context, mocker):
+    """Run execute_request() for given CR and patient JSON, FHIR and Twilio mocked
+
+    :return: (result, HAPI_transaction mock, CommunicationRequest PUT mock)
+    """
+    def run(cr_json, patient_json, process_cr=None):
+        mocker.patch(f"{MODULE}.resolve_reference", return_value=Patient(patient_json))
+        transaction = mocker.patch(
+            f"{MODULE}.HAPI_transaction",
+            return_value=["Communication/12", "CommunicationRequest/7"])
+        put = mocker.patch("isacc_messaging.models.isacc_communicationrequest.HAPI_request")
+        mocker.patch("isacc_messaging.models.isacc_communication.HAPI_request")
+        mocker.patch.object(IsaccRecordCreator, "process_cr", side_effect=process_cr)
+        cutoff = local_now() - timedelta(days=2)
+        result = IsaccRecordCreator().execute_request(cr_json, cutoff)
+        return result, transaction, put
+    return run
+
+
+def entries(call):
+    """(method, resourceType, status) of each transaction entry"""
+    return [(method, r["resourceType"], r["status"]) for method, r in call.args]
+
+
+def test_execute_request_sent(execute, patient_json):
+    result, transaction, put = execute(
+        cr_json(local_now()), patient_json,
+        process_cr=lambda cr, patient: ("in-progress", "Twilio message dispatched"))
+
+    assert result == (True, {"id": "7", "status": "Twilio message dispatched"}, None)
+    # Communication written with the request completed, ahead of the send
+    assert entries(transaction.call_args) == [
+        ("POST", "Communication", "in-progress"),
+        ("PUT", "CommunicationRequest", "completed")]
+    put.assert_not_called()
+
+
+@pytest.mark.parametrize("active, days_ago, reason", (
+    (False, 0, "Recipient is not active"),
+    (True, 3, "Past the cutoff"),
+))
+def test_execute_request_revoked(execute, patient_json, active, days_ago, reason):
+    patient_json["active"] = active
+    result, transaction, put = execute(
+        cr_json(local_now() - timedelta(days=days_ago)), patient_json)
+
+    assert result == (False, None, {"id": "7", "error": reason})
+    transaction.assert_not_called()
+    assert put.call_args.kwargs["resource"]["status"] == "revoked"
+
+
+def test_execute_request_already_dispatched(execute, patient_json):
+    dispatched = cr_json(local_now(), identifier=[{"system": TWILIO_SID_SYSTEM, "value": "SM1"}])
+    result, transaction, put = execute(dispatched, patient_json)
+
+    was_sent, success, error = result
+    assert not was_sent and success is None
+    assert "previously dispatched" in error["error"]
+    # completed without another Communication
+    transaction.assert_not_called()
+    assert put.call_args.kwargs["resource"]["status"] == "completed"
+
+
+def test_execute_request_unsubscribed(execute, patient_json):
+    patient_json["telecom"][0]["period"] = {"end": "2024-01-01T00:00:00Z"}
+    result, transaction, put = execute(cr_json(local_now()), patient_json)
+
+    assert result == (False, None, {"id": "7", "error": "Patient unsubscribed"})
+    transaction.assert_called_once()
+    assert entries(transaction.call_args) == [
+        ("POST", "Communication", "stopped"),
+        ("PUT", "CommunicationRequest", "revoked")]
+    put.assert_not_called()
+
+
+def test_execute_request_exception(execute, patient_json):
+    def fail(cr, patient):
+        raise RuntimeError("boom")
+
+    result, transaction, _ = execute(cr_json(local_now()), patient_json, process_cr=fail)
+
+    assert result == (True, None, None)
+    written, revoked = transaction.call_args_list
+    assert entries(written) == [
+        ("POST", "Communication", "in-progress"),
+        ("PUT", "CommunicationRequest", "completed")]
+    # request revoked, the Communication written ahead of the send marked unknown
+    assert entries(revoked) == [
+        ("PUT", "CommunicationRequest", "revoked"),
+        ("PUT", "Communication", "unknown")]
+    assert revoked.args[1][1]["id"] == "12"
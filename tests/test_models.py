@@ -3,9 +3,18 @@ from datetime import datetime, timedelta
 import json
 import os
 
+from fhirclient.models.period import Period
 from pytest import fixture
 
-from isacc_messaging.api.email_notifications import assemble_unresponded_email
+from isacc_messaging.api.email_notifications import assemble_unresponded_email, filter_patients
+from isacc_messaging.api.isacc_record_creator import expand_template_args
+from isacc_messaging.models.isacc_communicationrequest import (
+    IsaccCommunicationRequest as CommunicationRequest,
+    TWILIO_SID_SYSTEM,
+    TWILIO_STATUS_UPDATED_URL,
+    TWILIO_STATUS_URL,
+)
+from isacc_messaging.models.fhir import IsaccVersionConflict
 from isacc_messaging.models.isacc_fhirdate import IsaccFHIRDate as FHIRDate
 from isacc_messaging.models.isacc_patient import IsaccPatient as Patient
 from isacc_messaging.models.isacc_practitioner import IsaccPractitioner as Practitioner
@@ -90,6 +99,51 @@ def test_prac_email(practitioner_57):
     assert prac.email_address == "mcjustin+isaccuserrmcr@uw.edu"
 
 
+def test_patient_is_unsubscribed(patient_69):
+    patient = Patient(patient_69)
+    assert not patient.is_unsubscribed
+
+    patient.telecom[0].period = Period({"end": "2024-01-01T00:00:00Z"})
+    assert patient.is_unsubscribed
+
+
+def test_patient_persist_extension_conflict(mocker, patient_69):
+    url = "http://example.com/datetime"
+    value = "2024-01-01T00:00:00Z"
+    current = {**patient_69, "meta": {"versionId": "40"}}
+    request = mocker.patch(
+        "isacc_messaging.models.isacc_patient.HAPI_request",
+        side_effect=[IsaccVersionConflict("412"), current, current])
+
+    patient = Patient(patient_69)
+    patient.set_extension(url=url, value=value, attribute="valueDateTime")
+    patient.persist_extension(url=url, value=value, attribute="valueDateTime")
+
+    first_put, get, second_put = request.call_args_list
+    assert first_put.kwargs["headers"] == {"If-Match": 'W/"39"'}
+    assert get.args == ('GET', 'Patient')
+    assert second_put.kwargs["headers"] == {"If-Match": 'W/"40"'}
+    # extension value reapplied to the current version
+    assert {"url": url, "valueDateTime": value} in second_put.kwargs["resource"]["extension"]
+
+
+def test_patient_unsubscribe_conflict(mocker, patient_69):
+    current = {**patient_69, "meta": {"versionId": "40"}}
+    request = mocker.patch(
+        "isacc_messaging.models.isacc_patient.HAPI_request",
+        side_effect=[IsaccVersionConflict("412"), current, current])
+
+    patient = Patient(patient_69)
+    patient.unsubscribe()
+    assert patient.is_unsubscribed
+
+    first_put, get, second_put = request.call_args_list
+    assert first_put.kwargs["headers"] == {"If-Match": 'W/"39"'}
+    assert get.args == ('GET', 'Patient')
+    assert second_put.kwargs["headers"] == {"If-Match": 'W/"40"'}
+    # sms contact point ended on the current version
+    assert Patient(second_put.kwargs["resource"]).is_unsubscribed
+
 def test_unresponded_email_content(patient_69, patient_218, practitioner_57, app_context):
     p69 = Patient(patient_69)
     p218 = Patient(patient_218)
@@ -108,6 +162,68 @@ def test_unresponded_email_content(patient_69, patient_218, practitioner_57, app
     assert "There are 1 unanswered reply/ies for those whom you are following" in parts["html"]
 
 
+def test_filter_patients_memo(patient_69, patient_218):
+    p69 = Patient(patient_69)
+    p218 = Patient(patient_218)
+    evaluated = []
+
+    def keep_69(patient):
+        evaluated.append(patient.id)
+        return patient.id == p69.id
+
+    keeper_ids, skipper_ids = set(), set()
+    kept = filter_patients([p69, p218], keep_69, keeper_ids, skipper_ids)
+    assert [p.id for p in kept] == [p69.id]
+    assert keeper_ids == {p69.id}
+    assert skipper_ids == {p218.id}
+
+    # second practitioner sharing the same patients hits the memo
+    kept = filter_patients([p218, p69], keep_69, keeper_ids, skipper_ids)
+    assert [p.id for p in kept] == [p69.id]
+    assert len(evaluated) == 2
+
+
+def test_patients_by_practitioner(mocker, patient_69, patient_218):
+    # patient_69 is a test patient; mock another, missing from the included results
+    patient_300 = copy.deepcopy(patient_218)
+    patient_300["id"] = "300"
+
+    def careteam(id, subject, *participants):
+        return {
+            "resourceType": "CareTeam",
+            "id": id,
+            "subject": {"reference": subject},
+            "participant": list(participants)}
+
+    careteams = [
+        careteam(
+            "1", "Patient/218",
+            {"member": {"reference": "Practitioner/57"}},
+            {"member": {"reference": "Practitioner/10"}},
+            # member is optional, as is its reference
+            {"role": [{"text": "counselor"}]},
+            {"member": {"display": "Front desk"}},
+            {"member": {"reference": "Organization/1"}}),
+        careteam("2", "Patient/300", {"member": {"reference": "Practitioner/57"}}),
+        careteam("3", "Patient/69", {"member": {"reference": "Practitioner/57"}}),
+    ]
+    bundle = {
+        "resourceType": "Bundle",
+        "entry": [{"resource": r} for r in (*careteams, patient_218, patient_69)]}
+    mocker.patch(
+        "isacc_messaging.models.isacc_practitioner.HAPI_request", return_value=bundle)
+    resolve = mocker.patch(
+        "isacc_messaging.models.isacc_practitioner.resolve_reference",
+        return_value=Patient(patient_300))
+
+    by_practitioner = Practitioner.patients_by_practitioner()
+    assert {k: [p.id for p in v] for k, v in by_practitioner.items()} == {
+        "57": ["218", "300"],
+        "10": ["218"],
+    }
+    resolve.assert_called_once_with("Patient/300")
+
+
 def test_FHIRDate_compare():
     n = datetime.now().astimezone()
     dt1 = FHIRDate(n.isoformat())
@@ -132,3 +248,41 @@ def test_FHIRDate_str():
     dt1 = FHIRDate(n.isoformat())
     # some versions of datetime use tz offset rather than `Z`
     assert str(dt1) == n.isoformat().replace("+00:00", "Z")
+
+
+def test_expand_template_args(patient_69, practitioner_57):
+    patient = Patient(patient_69)
+    practitioner = Practitioner(practitioner_57)
+    content = "Hi {name}, {NAME}: {username} and {UserName} say hello"
+    assert expand_template_args(content, patient, practitioner) == (
+        "Hi Dwight, Dwight: J.R. and J.R. say hello")
+    assert expand_template_args("Hi {name}", patient, None) == "Hi Dwight"
+    assert expand_template_args("from {username}", patient, None) == "from Caring Contacts Team"
+    assert expand_template_args("Hello there", None, None) == "Hello there"
+
+
+def test_update_twilio_status():
+    cr = CommunicationRequest({
+        "resourceType": "CommunicationRequest",
+        "status": "active",
+        "identifier": [{
+            "system": TWILIO_SID_SYSTEM,
+            "value": "SM1",
+            "extension": [
+                {"url": TWILIO_STATUS_URL, "valueCode": "queued"},
+                {"url": TWILIO_STATUS_UPDATED_URL, "valueDateTime": "2024-01-01T00:00:00Z"},
+            ]}]})
+    assert cr.dispatched()
+
+    assert cr.update_twilio_status("SM2", "delivered") == []
+    test, replace_status, replace_updated = cr.update_twilio_status("SM1", "delivered")
+    status, updated = cr.identifier[0].extension
+    assert status.valueCode == "delivered"
+    assert updated.valueDateTime > FHIRDate("2024-01-01T00:00:00Z")
+
+    # matching JSON Patch operations, guarded by the sid
+    assert test == {"op": "test", "path": "/identifier/0/value", "value": "SM1"}
+    assert replace_status == {
+        "op": "replace", "path": "/identifier/0/extension/0/valueCode", "value": "delivered"}
+    assert replace_updated["path"] == "/identifier/0/extension/1/valueDateTime"
+    assert replace_updated["value"] == updated.valueDateTime.isostring